@@ -1,11 +1,44 @@
 #!/usr/bin/env python
 
 import multiprocessing, os, shutil, subprocess, sys, time, argparse, pickle, StringIO
-import fnmatch, re, json, sqlite3
+import threading, Queue, select, errno, signal, tempfile, math, socket
+import fnmatch, re, json, sqlite3, hashlib, collections, fcntl, ctypes, ctypes.util, struct
+from multiprocessing.pool import ThreadPool
 from sets import Set
 
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+# libc for copying files inside the kernel
+try:
+	libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+except OSError:
+	libc = None
+
 atran_path = os.path.dirname(os.path.realpath(__file__))
 dbc = None
+cache = None
+# in a pool worker, where the targets of the jobs it starts on go
+pool_starts = None
+
+# ways of copying a file, cheapest first. each mode falls back to the ones after it.
+copy_modes = ["link", "reflink", "kernel", "buffered"]
+
+# target formats whose files can be joined by writing one after the other, mp3 frames and chained
+# ogg streams
+joinable_exts = [".mp3", ".ogg", ".oga", ".opus"]
+
+# bitrates in kbit/s of mpeg 1 and mpeg 2 layer III frames, and the sample rates of mpeg 1
+mp3_bitrates = [
+	[0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+	[0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+]
+mp3_rates = [44100, 48000, 32000]
 
 #*		Settings
 #*	holds the global settings for the transcoder.
@@ -19,7 +52,36 @@ class Settings:
 		],
 		"default_script_path": "default-script.sh",
 		"multithreaded": True,
-		"cores": -1
+		"cores": -1,
+		"cache_path": "cache",
+		"cache_size": 0,
+		"scanner": "walk",
+		"queue_size": 64,
+		"default_copy_mode": "reflink",
+		"copy_threads": 4,
+		"schedule": "size",
+		"executor": "pool",
+		"job_timeout": 0,
+		"fanout": True,
+		"retry_delay": 3600,
+		"retry_limit": 5,
+		"split_duration": 0,
+		"segment_duration": 300,
+		"staging_path": "",
+		"staging_size": 1024,
+		"flush_threads": 1,
+		"watch_delay": 5,
+		"poll_interval": 900,
+		"progress_interval": 1,
+		"server_address": "localhost:7643",
+		"lease_time": 60,
+		"governor": False,
+		"min_cores": 1,
+		"max_cores": 0,
+		"max_load": 0,
+		"nice": 0,
+		"ionice": "",
+		"cpu_affinity": []
 	}
 
 	@staticmethod
@@ -50,6 +112,857 @@ class Path:
 	class AlreadyExists(Exception):
 		pass
 
+#*		FileIndex
+#*	persistent index of the source tree of a library, stored in the profile database. lets a scan
+#*	skip listing directories that haven't changed and notice source files that have been edited.
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+class FileIndex:
+	def __init__(self, lib):
+		self.lid = lib.id
+		self.source = lib.source
+		self.started = time.time()
+		# reldir -> [mtime, subdir names, file names]
+		self.dirs = dict()
+		# relpath -> [size, mtime, target size, target mtime]
+		self.files = dict()
+		# profile id -> relpath -> [size, mtime, target size, target mtime] for the extra output
+		# profiles of the library. the main profile, id 0, uses files.
+		self.profile_files = dict()
+		# (profile id, relpath) -> (size, mtime) of the sources queued by this scan
+		self.pending = dict()
+		# relpaths of sources queued for any profile by this scan
+		self.queued = set()
+		self.dirty_dirs = set()
+		self.dirty_files = set()
+		self.dirty_profile_files = set()
+		self.gone = set()
+		# (profile id, relpath) -> [size, mtime, script path, failures, time of the last failure] of
+		# sources the encoder failed on
+		self.failures = dict()
+		# (profile id, relpath) -> stderr of the last failure, for the failures to be saved
+		self.dirty_failures = dict()
+		self.gone_failures = set()
+		# sources left out of this scan because they keep failing
+		self.held = 0
+		# directories of this scan that couldn't be read, their outputs would look orphaned
+		self.unreadable = 0
+		# profile id -> target directory
+		self.targets = dict((p.id, p.target) for p in lib.outputs)
+		# profile id -> encoder script
+		self.scripts = dict((p.id, p.script_path) for p in lib.outputs)
+		# target path -> (profile id, relpath of the source) of every output the library has made
+		self.manifest = dict()
+		# target paths of every output the current scan maps a source to
+		self.seen = set()
+		self.dirty_manifest = set()
+		# target path -> profile id of outputs dropped from the manifest
+		self.gone_manifest = dict()
+		self.use_scandir = Settings.properties["scanner"] == "scandir" and scandir is not None
+		# absolute dir -> (mtime, subdir names, file names) of every directory seen this run. the
+		# planner gives libraries with overlapping sources the same dict, so a directory is only
+		# looked at once however many libraries and tracked paths it is under.
+		self.listings = dict()
+
+		if self.lid >= 0:
+			self.load()
+
+	# clears what the last scan found so the index can be scanned with again
+	def begin(self):
+		self.started = time.time()
+		self.pending = dict()
+		self.queued = set()
+		self.seen = set()
+		self.held = 0
+		self.unreadable = 0
+		self.listings = dict()
+
+	# reads the index for the library from the database
+	def load(self):
+		for row in dbc.execute("SELECT path, mtime FROM dirs WHERE lid=?", (self.lid,)):
+			self.dirs[row["path"]] = [row["mtime"], [], []]
+		for row in dbc.execute("SELECT path, parent FROM dirs WHERE lid=?", (self.lid,)):
+			# the source root is stored as its own parent
+			if row["parent"] in self.dirs and row["path"] != row["parent"]:
+				self.dirs[row["parent"]][1].append(os.path.basename(row["path"]))
+
+		c = dbc.execute("SELECT path, dir, size, mtime, target_size, target_mtime FROM files \
+			WHERE lid=?", (self.lid,))
+		for row in c:
+			self.files[row["path"]] = [row["size"], row["mtime"], row["target_size"], \
+				row["target_mtime"]]
+			if row["dir"] in self.dirs:
+				self.dirs[row["dir"]][2].append(os.path.basename(row["path"]))
+
+		c = dbc.execute("SELECT pid, path, size, mtime, target_size, target_mtime \
+			FROM profile_files WHERE lid=?", (self.lid,))
+		for row in c:
+			self.profile_files.setdefault(row["pid"], dict())[row["path"]] = [row["size"], \
+				row["mtime"], row["target_size"], row["target_mtime"]]
+
+		for row in dbc.execute("SELECT pid, path, source FROM outputs WHERE lid=?", (self.lid,)):
+			if row["pid"] in self.targets:
+				self.manifest[self.targets[row["pid"]]+os.sep+row["path"]] = (row["pid"], \
+					row["source"])
+
+		c = dbc.execute("SELECT pid, path, size, mtime, script_path, failures, last FROM failures \
+			WHERE lid=?", (self.lid,))
+		for row in c:
+			self.failures[(row["pid"], row["path"])] = [row["size"], row["mtime"], \
+				row["script_path"], row["failures"], row["last"]]
+
+	# walks the tree under a relative source directory, yielding (reldir, file names) for every
+	# directory. directories whose mtime is unchanged since the last scan are read from the index
+	# instead of being listed.
+	def walk(self, top):
+		stack = [top]
+		while stack:
+			reldir = stack.pop()
+			path = os.path.normpath(os.path.join(self.source, reldir))
+			listing = self.listings.get(path)
+			if listing is not None:
+				mtime = listing[0]
+			else:
+				try:
+					mtime = os.stat(path).st_mtime
+				except OSError as e:
+					self.walk_error(path, e)
+					continue
+
+			entry = self.dirs.get(reldir)
+			if entry is None or entry[0] != mtime:
+				try:
+					entry = self.relist(reldir, mtime, listing)
+				except OSError as e:
+					self.walk_error(path, e)
+					continue
+			if listing is None:
+				self.listings[path] = (mtime, entry[1], entry[2])
+
+			yield reldir, entry[2]
+			stack.extend(rel_join(reldir, d) for d in reversed(entry[1]))
+
+	# a directory the walk couldn't stat or list. one that has gone away is simply left out, its
+	# outputs are orphans. any other error is counted, so what's under it isn't taken for gone.
+	def walk_error(self, path, e):
+		if e.errno in [errno.ENOENT, errno.ENOTDIR]:
+			return
+		print >> sys.stderr, "Warning: Can't read '"+path+"' ("+e.strerror+"), skipping it."
+		self.unreadable += 1
+
+	# brings the entry of a directory in the index up to date, listing it from disk unless a
+	# listing from this run is given
+	def relist(self, reldir, mtime, listing=None):
+		path = os.path.join(self.source, reldir)
+		subdirs = []
+		files = []
+		if listing is not None:
+			subdirs = list(listing[1])
+			files = list(listing[2])
+		elif self.use_scandir:
+			# the file type comes from the directory listing itself, so there's no stat per entry
+			for entry in scandir(path):
+				if entry.is_dir(follow_symlinks=False):
+					subdirs.append(entry.name)
+				elif not entry.is_dir():
+					files.append(entry.name)
+			subdirs.sort()
+			files.sort()
+		else:
+			for name in sorted(os.listdir(path)):
+				full = os.path.join(path, name)
+				if not os.path.isdir(full):
+					files.append(name)
+				elif not os.path.islink(full):
+					# same as os.walk, symlinked directories are not followed
+					subdirs.append(name)
+
+		old = self.dirs.get(reldir)
+		if old is not None:
+			for name in set(old[1]) - set(subdirs):
+				self.forget(rel_join(reldir, name), True)
+			for name in set(old[2]) - set(files):
+				self.forget(rel_join(reldir, name))
+
+		for name in files:
+			rel = rel_join(reldir, name)
+			if rel not in self.files:
+				self.files[rel] = [None, None, None, None]
+				self.dirty_files.add(rel)
+
+		# a directory modified during this scan could change again within the same mtime tick, so
+		# don't trust its mtime until the next scan.
+		if mtime >= self.started - 1:
+			mtime = None
+
+		entry = [mtime, subdirs, files]
+		self.dirs[reldir] = entry
+		self.dirty_dirs.add(reldir)
+		return entry
+
+	# drops a file, or a whole directory tree, from the index
+	def forget(self, rel, tree=False):
+		if tree:
+			prefix = rel+"/"
+			for d in [d for d in self.dirs if d == rel or d.startswith(prefix)]:
+				del self.dirs[d]
+				self.dirty_dirs.discard(d)
+			for f in [f for f in self.files if f.startswith(prefix)]:
+				del self.files[f]
+				self.dirty_files.discard(f)
+			for pid, files in self.profile_files.items():
+				for f in [f for f in files if f.startswith(prefix)]:
+					del files[f]
+					self.dirty_profile_files.discard((pid, f))
+			for key in [k for k in self.failures if k[1].startswith(prefix)]:
+				del self.failures[key]
+				self.dirty_failures.pop(key, None)
+		else:
+			self.files.pop(rel, None)
+			self.dirty_files.discard(rel)
+			for pid, files in self.profile_files.items():
+				files.pop(rel, None)
+				self.dirty_profile_files.discard((pid, rel))
+			for key in [k for k in self.failures if k[1] == rel]:
+				del self.failures[key]
+				self.dirty_failures.pop(key, None)
+		self.gone.add(rel)
+
+	# checks a source file against its recorded state for an output profile. returns True if it
+	# has to be processed, False if it is up to date and None if it is held back after failing.
+	# exists can be given if the caller already knows whether the target file exists.
+	def changed(self, rel, dst, force=False, exists=None, pid=0):
+		st = os.stat(self.source+os.sep+rel)
+		self.seen.add(dst)
+		if pid == 0:
+			state = self.files.get(rel)
+		else:
+			state = self.profile_files.get(pid, dict()).get(rel)
+
+		if not force:
+			if exists is None:
+				exists = os.path.exists(dst)
+
+			if not exists:
+				pass
+			elif state is None or state[0] is None:
+				# never seen this file processed. an existing target is trusted to be up to date.
+				try:
+					self.record(rel, (st.st_size, st.st_mtime), os.stat(dst), pid, dst)
+					return False
+				except OSError:
+					pass
+			elif state[0] == st.st_size and state[1] == st.st_mtime:
+				if dst not in self.manifest:
+					# made before outputs were kept track of
+					self.add_output(dst, pid, rel)
+				return False
+
+			if self.holding(rel, st, pid):
+				self.held += 1
+				return None
+
+		self.pending[(pid, rel)] = (st.st_size, st.st_mtime)
+		self.queued.add(rel)
+		return True
+
+	# whether a source the encoder failed on is held back, waiting for its next retry or for good
+	# once it has failed retry_limit times. changing the source or the script lets it through.
+	def holding(self, rel, st, pid):
+		failure = self.failures.get((pid, rel))
+		if failure is None or failure[:3] != [st.st_size, st.st_mtime, self.scripts[pid]]:
+			return False
+		limit = Settings.properties["retry_limit"]
+		if limit > 0 and failure[3] >= limit:
+			return True
+		return time.time() < failure[4]+retry_delay(failure[3])
+
+	# records the state of the sources of finished jobs, given as (src, dst) tuples
+	def done(self, jobs, pid=0):
+		for src, dst in jobs:
+			rel = os.path.relpath(src, self.source)
+			if (pid, rel) in self.failures:
+				del self.failures[(pid, rel)]
+				self.dirty_failures.pop((pid, rel), None)
+				self.gone_failures.add((pid, rel))
+			try:
+				self.record(rel, self.pending.pop((pid, rel)), os.stat(dst), pid, dst)
+			except (KeyError, OSError):
+				pass
+
+	# records a failure for the sources of jobs the encoder failed on, given as (src, stderr)
+	# tuples. failures are counted for as long as the source and script stay the same.
+	def failed(self, jobs, pid=0):
+		for src, stderr in jobs:
+			rel = os.path.relpath(src, self.source)
+			state = self.pending.pop((pid, rel), None)
+			if state is None:
+				continue
+			failure = self.failures.get((pid, rel))
+			count = 1
+			if failure is not None and failure[:3] == [state[0], state[1], self.scripts[pid]]:
+				count = failure[3]+1
+			self.failures[(pid, rel)] = [state[0], state[1], self.scripts[pid], count, time.time()]
+			self.dirty_failures[(pid, rel)] = stderr
+			self.gone_failures.discard((pid, rel))
+
+	def record(self, rel, state, tst, pid, dst):
+		self.add_output(dst, pid, rel)
+		if pid == 0:
+			self.files[rel] = [state[0], state[1], tst.st_size, tst.st_mtime]
+			self.dirty_files.add(rel)
+		else:
+			self.profile_files.setdefault(pid, dict())[rel] = [state[0], state[1], tst.st_size, \
+				tst.st_mtime]
+			self.dirty_profile_files.add((pid, rel))
+
+	# adds an output to the manifest
+	def add_output(self, dst, pid, rel):
+		self.manifest[dst] = (pid, rel)
+		self.dirty_manifest.add(dst)
+		self.gone_manifest.pop(dst, None)
+
+	# outputs in the manifest that no source in the scan maps to any more
+	def orphans(self):
+		return [dst for dst in self.manifest if dst not in self.seen]
+
+	# drops outputs from the manifest
+	def drop_outputs(self, targets):
+		for dst in targets:
+			pid, rel = self.manifest.pop(dst)
+			self.dirty_manifest.discard(dst)
+			self.gone_manifest[dst] = pid
+
+	# a target path relative to the target directory of its profile
+	def output_path(self, dst, pid):
+		return dst[len(self.targets[pid])+1:]
+
+	# writes any changes to the index back to the database
+	def save(self):
+		if self.lid < 0:
+			return
+
+		for rel in self.gone:
+			for table in ["dirs", "files", "profile_files", "failures"]:
+				dbc.execute("DELETE FROM "+table+" WHERE lid=? AND (path=? OR (path>=? AND path<?))", \
+					(self.lid, rel, rel+"/", rel+"0"))
+		dbc.executemany("INSERT OR REPLACE INTO dirs VALUES (NULL,?,?,?,?)", \
+			[(self.lid, d, rel_dir(d), self.dirs[d][0]) for d in self.dirty_dirs])
+		dbc.executemany("INSERT OR REPLACE INTO files VALUES (NULL,?,?,?,?,?,?,?)", \
+			[(self.lid, f, rel_dir(f)) + tuple(self.files[f]) for f in self.dirty_files])
+		dbc.executemany("INSERT OR REPLACE INTO profile_files VALUES (NULL,?,?,?,?,?,?,?)", \
+			[(self.lid, pid, f) + tuple(self.profile_files[pid][f]) \
+				for pid, f in self.dirty_profile_files])
+		dbc.executemany("DELETE FROM outputs WHERE pid=? AND lid=? AND path=?", \
+			[(pid, self.lid, self.output_path(dst, pid)) for dst, pid in self.gone_manifest.items()])
+		dbc.executemany("INSERT OR REPLACE INTO outputs VALUES (NULL,?,?,?,?)", \
+			[(self.lid, self.manifest[dst][0], self.output_path(dst, self.manifest[dst][0]), \
+				self.manifest[dst][1]) for dst in self.dirty_manifest])
+		dbc.executemany("DELETE FROM failures WHERE lid=? AND pid=? AND path=?", \
+			[(self.lid, pid, rel) for pid, rel in self.gone_failures])
+		dbc.executemany("INSERT OR REPLACE INTO failures VALUES (NULL,?,?,?,?,?,?,?,?,?)", \
+			[(self.lid, pid, rel) + tuple(self.failures[(pid, rel)]) + (stderr,) \
+				for (pid, rel), stderr in self.dirty_failures.items()])
+		dbc.commit()
+
+		self.gone = set()
+		self.dirty_dirs = set()
+		self.dirty_files = set()
+		self.dirty_profile_files = set()
+		self.dirty_manifest = set()
+		self.gone_manifest = dict()
+		self.dirty_failures = dict()
+		self.gone_failures = set()
+
+	# removes the whole index of a library
+	@staticmethod
+	def clear(lid):
+		dbc.execute("DELETE FROM dirs WHERE lid=?", (lid,))
+		dbc.execute("DELETE FROM files WHERE lid=?", (lid,))
+		dbc.execute("DELETE FROM profile_files WHERE lid=?", (lid,))
+		dbc.execute("DELETE FROM outputs WHERE lid=?", (lid,))
+		dbc.execute("DELETE FROM failures WHERE lid=?", (lid,))
+		dbc.execute("DELETE FROM journal WHERE lid=?", (lid,))
+
+#*		TranscodeCache
+#*	content addressed store of encoder outputs shared by all libraries. outputs are keyed by the
+#*	contents of the source file, the contents of the encoder script and the target extension.
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+class TranscodeCache:
+	def __init__(self, path, size):
+		self.path = path
+		self.size = size
+		self.hits = 0
+		self.misses = 0
+		self.script_hashes = dict()
+
+	# the path in the cache for the output of a job
+	def key(self, script_path, src, dst):
+		if script_path not in self.script_hashes:
+			self.script_hashes[script_path] = hash_file(script_path)
+		ext = os.path.splitext(dst)[1]
+		h = hashlib.sha1(hash_file(src)+self.script_hashes[script_path]+ext).hexdigest()
+		return os.path.join(self.path, h[:2], h+ext)
+
+	# places a cached output at dst. returns False if there is nothing cached for the key.
+	def fetch(self, key, dst):
+		if not os.path.isfile(key):
+			return False
+		# renaming a link over another link to the same file does nothing and would leave tmp
+		# behind, the output is already in place then
+		if os.path.exists(dst) and os.path.samefile(key, dst):
+			os.utime(key, None)
+			return True
+		tmp = temp_path(dst)
+		if os.path.lexists(tmp):
+			os.remove(tmp)
+		link_or_copy(key, tmp)
+		os.rename(tmp, dst)
+		# the mtime of a cached output is when it was last used
+		os.utime(key, None)
+		return True
+
+	# adds a finished output to the cache
+	def store(self, key, dst):
+		if not os.path.isdir(os.path.dirname(key)):
+			try:
+				os.makedirs(os.path.dirname(key))
+			except OSError:
+				# another worker got there first
+				pass
+		tmp = key+"."+str(os.getpid())
+		link_or_copy(dst, tmp)
+		os.rename(tmp, key)
+
+	# tallies up the results returned by the workers
+	def count(self, results):
+		self.hits += results.count("hit")
+		self.misses += results.count("miss")
+
+	# removes the least recently used outputs until the cache fits in its size limit
+	def evict(self):
+		entries = []
+		total = 0
+		for root, dirs, files in os.walk(self.path):
+			for f in files:
+				st = os.stat(os.path.join(root, f))
+				entries.append((st.st_mtime, st.st_size, os.path.join(root, f)))
+				total += st.st_size
+
+		entries.sort()
+		for mtime, size, path in entries:
+			if total <= self.size:
+				break
+			os.remove(path)
+			total -= size
+
+#*		JobHistory
+#*	timings of every transcode job, kept in the jobs table for the stats command. the jobs are
+#*	written out together at the end of a run.
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+class JobHistory:
+	def __init__(self):
+		self.jobs = []
+
+	# adds a finished job given its result from job_result
+	def add(self, lib, profile, src, dst, result):
+		cached, start, end, returncode, src_size, dst_size = result[:6]
+		self.jobs.append((lib.name, profile.script_path, src, dst, src_size, dst_size, start, end, \
+			returncode, cached == "hit"))
+
+	def save(self):
+		dbc.executemany("INSERT INTO jobs VALUES (NULL,?,?,?,?,?,?,?,?,?,?)", self.jobs)
+		dbc.commit()
+		self.jobs = []
+
+	# source bytes a second a script got through over its last jobs that ran an encoder and
+	# succeeded. None if it hasn't any.
+	@staticmethod
+	def throughput(script_path, jobs=1000):
+		row = dbc.execute("SELECT SUM(source_size) AS source, SUM(end-start) AS time FROM \
+			(SELECT source_size, start, end FROM jobs WHERE script_path=? AND status=0 AND \
+			NOT cached AND source_size IS NOT NULL ORDER BY id DESC LIMIT ?)", \
+			(script_path, jobs)).fetchone()
+		if not row["source"] or not row["time"]:
+			return None
+		return row["source"]/row["time"]
+
+	# prints throughput, compression and the slowest files from the recorded jobs, optionally of
+	# just one library. speeds only count jobs that ran an encoder and succeeded.
+	@staticmethod
+	def report(library=None, slowest=10):
+		where = "WHERE library=?" if library else "WHERE 1"
+		params = (library,) if library else ()
+		encoded = where+" AND status=0 AND NOT cached"
+
+		total = dbc.execute("SELECT COUNT(*) FROM jobs "+where, params).fetchone()[0]
+		if total == 0:
+			print "No jobs recorded."
+			return
+
+		for title, name, column in [("Libraries", "library", "library"), \
+				("Scripts", "script", "script_path")]:
+			print title
+			print "  %-30s %7s %6s %6s %10s %9s %8s %7s" % (name, "jobs", "failed", \
+				"cached", "source MB", "time (s)", "MB/s", "ratio")
+			c = dbc.execute("SELECT "+column+" AS name, COUNT(*) AS jobs, \
+				SUM(status!=0) AS failed, SUM(cached) AS cached, \
+				SUM(CASE WHEN status=0 AND NOT cached THEN source_size END) AS source, \
+				SUM(CASE WHEN status=0 AND NOT cached THEN target_size END) AS target, \
+				SUM(CASE WHEN status=0 AND NOT cached THEN end-start END) AS time \
+				FROM jobs "+where+" GROUP BY "+column+" ORDER BY "+column, params)
+			for row in c:
+				print "  %-30s %7d %6d %6d %10.1f %9.1f %8s %7s" % (row["name"], row["jobs"], \
+					row["failed"], row["cached"], (row["source"] or 0)/1048576.0, row["time"] or 0, \
+					rate(row["source"], row["time"]), ratio(row["target"], row["source"]))
+			print
+
+		print "Slowest files"
+		c = dbc.execute("SELECT target, end-start AS time, source_size FROM jobs "+encoded+" \
+			ORDER BY end-start DESC LIMIT ?", params+(slowest,))
+		for row in c:
+			print "  %8.1fs %8s MB/s  %s" % (row["time"], rate(row["source_size"], row["time"]), \
+				row["target"])
+		print
+
+		print "Encoder speed by day"
+		c = dbc.execute("SELECT date(start, 'unixepoch', 'localtime') AS day, script_path, \
+			COUNT(*) AS jobs, SUM(source_size) AS source, SUM(end-start) AS time FROM jobs \
+			"+encoded+" GROUP BY day, script_path ORDER BY day, script_path", params)
+		for row in c:
+			print "  %s %7d jobs %8s MB/s  %s" % (row["day"], row["jobs"], \
+				rate(row["source"], row["time"]), row["script_path"])
+
+#*		Journal
+#*	the state of every job of a run, queued, running, done or failed, kept in the journal table so
+#*	a run that was interrupted can be picked up by the next one. rows are written in batches and
+#*	cleared once a run finishes.
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+class Journal:
+	# seconds between writes to the database
+	interval = 1.0
+
+	def __init__(self):
+		self.rows = []
+		self.flushed = time.time()
+
+	# picks up what an interrupted run left for a library. jobs that were queued or running are
+	# found again by the scan, and the outputs the running ones were writing are removed. jobs that
+	# finished after the index was last saved are added to it so they aren't done again.
+	def resume(self, lib):
+		if lib.id < 0:
+			return
+
+		unfinished = 0
+		started = 0
+		c = dbc.execute("SELECT pid, source, target, state FROM journal WHERE lid=?", (lib.id,))
+		for row in c.fetchall():
+			if row["state"] == "queued":
+				unfinished += 1
+			elif row["state"] == "running":
+				unfinished += 1
+				started += 1
+				commit_output((None, None, row["target"]), -1)
+				shutil.rmtree(parts_path(row["target"]), True)
+			elif row["state"] == "done" and row["pid"] in lib.index.targets:
+				# outputs still in staging are finished, they only need flushing
+				staged = staged_path(row["target"])
+				if staged is not None and os.path.exists(staged):
+					move_staged(staged, row["target"])
+				try:
+					st = os.stat(os.path.join(lib.source, row["source"]))
+					lib.index.record(row["source"], (st.st_size, st.st_mtime), \
+						os.stat(row["target"]), row["pid"], row["target"])
+				except OSError:
+					pass
+		dbc.execute("DELETE FROM journal WHERE lid=?", (lib.id,))
+		dbc.commit()
+
+		if unfinished > 0:
+			print "  [",lib.name,"] resuming,",unfinished,"jobs left unfinished by the last run,", \
+				started,"of them started"
+
+	# moves (src, dst, profile) records of a library to a new state
+	def update(self, lib, records, state):
+		if lib.id < 0:
+			return
+		for src, dst, profile in records:
+			self.rows.append((lib.id, profile.id, os.path.relpath(src, lib.source), dst, state))
+		if time.time()-self.flushed >= Journal.interval:
+			self.flush()
+
+	def flush(self):
+		dbc.executemany("INSERT OR REPLACE INTO journal VALUES (NULL,?,?,?,?,?)", self.rows)
+		dbc.commit()
+		self.rows = []
+		self.flushed = time.time()
+
+	# clears the journal of libraries that have been run to the end
+	def clear(self, libraries):
+		self.rows = []
+		dbc.executemany("DELETE FROM journal WHERE lid=?", [(lib.id,) for lib in libraries])
+		dbc.commit()
+
+#*		Progress
+#*	reports on a run as it goes. every job queued, started, finished or failed is written as a json
+#*	line to out, along with a snapshot of the whole run every progress_interval seconds giving the
+#*	rate jobs and source data go through at, how busy the workers are and how long is left. with
+#*	status on the snapshot is also shown as a single line on the terminal.
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+class Progress:
+	kinds = ["transcode", "copy"]
+
+	def __init__(self, out=None, status=False, workers=1):
+		self.out = out
+		self.status = status and sys.stderr.isatty()
+		self.workers = max(1, workers)
+		self.begun = time.time()
+		# when the first job was started, rates are worked out from here, and when a job last
+		# finished
+		self.first = None
+		self.last = None
+		self.ticked = 0
+		# target -> (source size, time started) of the jobs that haven't finished
+		self.queued = dict()
+		self.running = dict()
+		# transcode jobs out with the workers
+		self.encoding = 0
+		self.finished = 0
+		self.failed = 0
+		# bytes of source of the transcode jobs left and done, and seconds spent encoding
+		self.left = 0
+		self.done = 0
+		self.busy = 0.0
+
+	# (src, dst, profile) records of a library have been found. kind is 0 for transcode jobs and 1
+	# for copy jobs.
+	def queue(self, lib, records, kind):
+		for src, dst, profile in records:
+			try:
+				size = os.stat(src).st_size
+			except OSError:
+				size = 0
+			self.queued[dst] = (size, None)
+			if kind == 0:
+				self.left += size
+			self.event("queued", lib, kind, src, dst, size)
+
+	# the encoders or copies of the records have started
+	def start(self, lib, records, kind):
+		now = time.time()
+		if self.first is None:
+			self.first = self.last = now
+		for src, dst, profile in records:
+			size = self.queued.pop(dst, (0, None))[0]
+			self.running[dst] = (size, now)
+			if kind == 0:
+				self.encoding += 1
+			self.event("started", lib, kind, src, dst, size)
+
+	# the records have finished, with the results of their job
+	def finish(self, lib, records, kind, results):
+		now = time.time()
+		self.last = now
+		for i, (src, dst, profile) in enumerate(records):
+			if dst in self.running:
+				size, started = self.running.pop(dst)
+				self.encoding -= 1 if kind == 0 else 0
+			else:
+				size, started = self.queued.pop(dst, (0, None))[0], now
+			result = results[i]
+			if kind == 0:
+				self.left -= size
+				self.done += size
+			if result is None:
+				# interrupted, the output wasn't made
+				self.failed += 1
+				self.event("failed", lib, kind, src, dst, size, None, now-started)
+			else:
+				if kind == 0:
+					self.busy += result[2]-result[1]
+				if result[3] == 0:
+					self.finished += 1
+				else:
+					self.failed += 1
+				self.event("finished" if result[3] == 0 else "failed", lib, kind, src, dst, size, \
+					result[3], result[2]-result[1])
+
+	def event(self, name, lib, kind, src, dst, size, status=None, seconds=None):
+		if self.out is not None:
+			d = {"event": name, "time": round(time.time(), 3), "library": lib.name,
+				"kind": Progress.kinds[kind], "source": src, "target": dst, "size": size}
+			if seconds is not None:
+				d["status"] = status
+				d["seconds"] = round(seconds, 3)
+			self.write(d)
+		self.tick()
+
+	# writes a snapshot if it's time for one
+	def tick(self):
+		if time.time()-self.ticked >= Settings.properties["progress_interval"]:
+			self.report()
+
+	def report(self):
+		self.ticked = time.time()
+		d = self.snapshot()
+		if self.out is not None:
+			self.write(d)
+		if self.status:
+			sys.stderr.write("\r"+self.line(d)+"\033[K")
+			sys.stderr.flush()
+
+	# the state of the whole run
+	def snapshot(self):
+		now = time.time()
+		elapsed = now-(self.first or now)
+		jobs = self.finished+self.failed
+		d = {"event": "snapshot", "time": round(now, 3), "elapsed": round(now-self.begun, 3),
+			"queued": len(self.queued), "running": len(self.running), "finished": self.finished,
+			"failed": self.failed, "jobs_per_sec": None, "source_mb_per_sec": None,
+			"utilization": None, "eta": None}
+		if elapsed > 0:
+			d["jobs_per_sec"] = round(jobs/elapsed, 2)
+			d["source_mb_per_sec"] = round(self.done/1048576.0/elapsed, 2)
+			# the workers are taken to have been busy since a job last finished, as far as there
+			# are jobs for them. a job's own time is counted once it finishes.
+			busy = self.busy+min(self.encoding, self.workers)*(now-self.last)
+			d["utilization"] = round(min(1.0, busy/(self.workers*elapsed)), 3)
+			# big sources take longer, so what's left is measured in bytes not jobs
+			if self.done > 0:
+				d["eta"] = round(self.left*elapsed/self.done, 1)
+		return d
+
+	# a snapshot as a line for the terminal
+	def line(self, d):
+		total = d["queued"]+d["running"]+d["finished"]+d["failed"]
+		parts = ["%d/%d jobs" % (d["finished"]+d["failed"], total)]
+		if d["failed"] > 0:
+			parts.append("%d failed" % d["failed"])
+		if d["jobs_per_sec"] is not None:
+			parts.append("%.1f jobs/s" % d["jobs_per_sec"])
+			parts.append("%.1f MB/s" % d["source_mb_per_sec"])
+			parts.append("%d%% busy" % (d["utilization"]*100))
+		if d["eta"] is not None:
+			parts.append("eta "+format_duration(d["eta"]))
+		return "  "+", ".join(parts)
+
+	def write(self, d):
+		self.out.write(json.dumps(d, sort_keys=True)+"\n")
+		self.out.flush()
+
+	# writes the last snapshot at the end of a run
+	def close(self):
+		self.report()
+		if self.status:
+			sys.stderr.write("\n")
+
+#*		Flusher
+#*	moves outputs from the staging directory to their targets, so encoders never write to a slow
+#*	target device. finished outputs are gathered and written out in batches in target path order,
+#*	with flush_threads threads for each target device. encoding is held up while the staged
+#*	outputs take up more than staging_size.
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+class Flusher:
+	# seconds without a new output before a batch is written out anyway
+	delay = 1.0
+
+	def __init__(self, size, threads):
+		self.size = size
+		self.threads = threads
+		self.cond = threading.Condition()
+		# bytes staged and not flushed yet
+		self.staged = 0
+		# device -> [outputs waiting for a batch, sorted batch being written, threads]
+		self.devices = dict()
+		# target directory -> device
+		self.dirs = dict()
+		self.added = time.time()
+		self.closed = False
+		# (item, whether it was flushed) of every output that has been dealt with
+		self.done = Queue.Queue()
+
+		path = os.path.join(atran_path, Settings.properties["staging_path"])
+		if not os.path.isdir(path):
+			os.makedirs(path)
+
+	# queues a staged output to be moved to dst. item is handed back through done.
+	def add(self, dst, item):
+		tdir = os.path.dirname(dst)
+		if tdir not in self.dirs:
+			self.dirs[tdir] = os.stat(tdir).st_dev
+		dev = self.dirs[tdir]
+
+		staged = staged_path(dst)
+		size = os.path.getsize(staged)
+		with self.cond:
+			if dev not in self.devices:
+				self.devices[dev] = [[], collections.deque(), []]
+				for i in range(self.threads):
+					t = threading.Thread(target=self.flush, args=(self.devices[dev],))
+					t.daemon = True
+					t.start()
+					self.devices[dev][2].append(t)
+			self.devices[dev][0].append((dst, staged, size, item))
+			self.staged += size
+			self.added = time.time()
+			self.cond.notify_all()
+
+	# whether the staging directory is over its size
+	def full(self):
+		return self.size > 0 and self.staged >= self.size
+
+	# waits for some of the staged outputs to be flushed
+	def wait(self):
+		with self.cond:
+			if self.full():
+				self.cond.wait(Flusher.delay)
+
+	# flushes everything left and waits for the threads to finish
+	def close(self):
+		with self.cond:
+			self.closed = True
+			self.cond.notify_all()
+		for waiting, batch, threads in self.devices.values():
+			for t in threads:
+				while t.is_alive():
+					t.join(0xffff)
+
+	# writes out the batches of one device. a batch is started once the staging directory is half
+	# full, nothing new has come in for a while or the flusher is closing.
+	def flush(self, device):
+		waiting, batch, threads = device
+		while True:
+			with self.cond:
+				while not batch:
+					if waiting and (self.closed or (self.size > 0 and self.staged*2 >= self.size) \
+							or time.time()-self.added >= Flusher.delay):
+						batch.extend(sorted(waiting))
+						del waiting[:]
+					elif self.closed:
+						return
+					else:
+						self.cond.wait(Flusher.delay)
+				dst, staged, size, item = batch.popleft()
+
+			ok = move_staged(staged, dst)
+			with self.cond:
+				self.staged -= size
+				self.cond.notify_all()
+			self.done.put((item, ok))
+
+#*		Profile
+#*	an output of a library, a target directory with the extension and script to transcode into it.
+#*	the library's own target is profile 0, any others are stored in the profiles table.
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+class Profile:
+	def __init__(self, pid, target, ext, script_path):
+		self.id = pid
+		self.target = target
+		self.ext = ext
+		self.script_path = script_path
+
+	def __str__(self):
+		return self.target+" ("+self.ext+", "+self.script_path+")"
+
 #*		Library
 #*	handles each library of audio files.
 #*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
@@ -63,6 +976,13 @@ class Library:
 			self.path = path
 	class AlreadyExists(Exception):
 		pass
+	class ProfileExists(Exception):
+		pass
+	class ProfileNotFound(Exception):
+		pass
+
+	# the format of the header of an exported library
+	export_format = "atran-library"
 
 	def __init__(self, *args, **kwargs):
 		if len(args) == 1:
@@ -77,6 +997,7 @@ class Library:
 				self.script_path = row["script_path"]
 				self.exts = [row["source_ext"], row["target_ext"]]
 				self.cexts = row["copy_ext"].split(" ")
+				self.copy_mode = row["copy_mode"]
 				self.paths = []
 			except TypeError:
 				raise Library.NotFound
@@ -90,6 +1011,7 @@ class Library:
 			self.script_path = Settings.properties["default_script_path"].encode('ascii', 'ignore')
 			self.exts = [e for e in Settings.properties["default_exts"]]
 			self.cexts = [e for e in Settings.properties["default_copy_exts"]]
+			self.copy_mode = Settings.properties["default_copy_mode"]
 		elif len(args) == 3:
 			# create a new Library object and store it as a new library in the database.
 			self.name = args[0]
@@ -99,6 +1021,8 @@ class Library:
 			self.script_path = Settings.properties["default_script_path"].encode('ascii', 'ignore')
 			self.exts = [e for e in Settings.properties["default_exts"]]
 			self.cexts = [e for e in Settings.properties["default_copy_exts"]]
+			self.copy_mode = Settings.properties["default_copy_mode"]
+			self.profiles = []
 
 			self.save()
 		else:
@@ -108,6 +1032,8 @@ class Library:
 			self.script_path = Settings.properties["default_script_path"].encode('ascii', 'ignore')
 			self.exts = [e for e in Settings.properties["default_exts"]]
 			self.cexts = [e for e in Settings.properties["default_copy_exts"]]
+			self.copy_mode = Settings.properties["default_copy_mode"]
+			self.profiles = []
 
 	def __str__(self):
 		val = dbc.execute("SELECT COUNT(path) FROM paths WHERE lid=?", (self.id,)).fetchone()[0]
@@ -117,7 +1043,9 @@ class Library:
 			+"  script path = "+self.script_path+"\n" \
 			+"  source ext  = "+self.exts[0]+"\n" \
 			+"  target ext  = "+self.exts[1]+"\n" \
-			+"  copy exts   = "+", ".join(self.cexts);
+			+"  copy exts   = "+", ".join(self.cexts)+"\n" \
+			+"  copy mode   = "+self.copy_mode \
+			+"".join("\n  profile     = "+str(p) for p in self.fetch_profiles()[1:]);
 
 	# adds a path to the library
 	def add_path(self, path, check=True):
@@ -130,10 +1058,27 @@ class Library:
 			raise Path.AlreadyExists
 		return 0
 
+	# adds many paths in a single transaction. returns the number of paths that weren't in the
+	# library already.
+	def add_paths(self, paths, check=True):
+		if check:
+			paths = [self.check_path(path) for path in paths]
+		before = dbc.total_changes
+		dbc.executemany("INSERT OR IGNORE INTO paths VALUES (NULL,?,?)", \
+			((self.id, path) for path in paths))
+		dbc.commit()
+		return dbc.total_changes-before
+
 	# removes all paths under a given root directory
 	def remove_path(self, path):
-		path = self.check_path(path)
-		dbc.execute("DELETE FROM paths WHERE lid=? AND path LIKE ?", (self.id, path+"%"))
+		path = self.check_path(path).rstrip("/")
+		if path in [".", ""]:
+			dbc.execute("DELETE FROM paths WHERE lid=?", (self.id,))
+		else:
+			# a range on the (lid, path) index, everything starting with "path/". "0" sorts
+			# straight after "/".
+			dbc.execute("DELETE FROM paths WHERE lid=? AND (path=? OR (path>=? AND path<?))", \
+				(self.id, path, path+"/", path+"0"))
 		dbc.commit()
 		return 0
 
@@ -149,6 +1094,42 @@ class Library:
 		dbc.execute("UPDATE libraries SET script_path=? WHERE id=?", (path, self.id))
 		dbc.commit()
 
+	# sets how copy files are copied
+	def set_copy_mode(self, mode):
+		dbc.execute("UPDATE libraries SET copy_mode=? WHERE id=?", (mode, self.id))
+		dbc.commit()
+
+	# adds an output profile transcoding into another target directory
+	def add_profile(self, target, ext, script_path, commit=True):
+		target = os.path.abspath(target)
+		if target == self.target or dbc.execute("SELECT id FROM profiles WHERE lid=? AND target=?", \
+				(self.id, target)).fetchone() is not None:
+			raise Library.ProfileExists
+		dbc.execute("INSERT INTO profiles VALUES (NULL,?,?,?,?)", (self.id, target, ext, script_path))
+		if commit:
+			dbc.commit()
+
+	# removes the output profile with a target directory, and what is known about its files
+	def remove_profile(self, target):
+		row = dbc.execute("SELECT id FROM profiles WHERE lid=? AND target=?", \
+			(self.id, os.path.abspath(target))).fetchone()
+		if row is None:
+			raise Library.ProfileNotFound
+		dbc.execute("DELETE FROM profiles WHERE id=?", (row["id"],))
+		dbc.execute("DELETE FROM profile_files WHERE pid=?", (row["id"],))
+		dbc.execute("DELETE FROM outputs WHERE pid=?", (row["id"],))
+		dbc.execute("DELETE FROM failures WHERE pid=?", (row["id"],))
+		dbc.commit()
+
+	# the output profiles of the library, its own target first
+	def fetch_profiles(self):
+		profiles = [Profile(0, self.target, self.exts[1], self.script_path)]
+		if self.id >= 0:
+			c = dbc.execute("SELECT * FROM profiles WHERE lid=? ORDER BY id ASC", (self.id,))
+			profiles.extend(Profile(row["id"], row["target"], row["target_ext"], \
+				row["script_path"]) for row in c)
+		return profiles
+
 	# manipulate the extensions
 	def ext(self, *args, **kwargs):
 		if args[0] == "source":
@@ -183,10 +1164,44 @@ class Library:
 			print "  ",path
 		print "["+str(len(self.paths))+" total]"
 
+	# list the source files the encoder has failed on, with when they will be tried again and the
+	# end of what the encoder wrote to stderr the last time
+	def list_failures(self):
+		outputs = dict((p.id, p) for p in self.fetch_profiles())
+		limit = Settings.properties["retry_limit"]
+		rows = dbc.execute("SELECT * FROM failures WHERE lid=? ORDER BY path ASC, pid ASC", \
+			(self.id,)).fetchall()
+		for row in rows:
+			output = outputs.get(row["pid"])
+			try:
+				st = os.stat(os.path.join(self.source, row["path"]))
+				changed = st.st_size != row["size"] or st.st_mtime != row["mtime"] or \
+					output is None or row["script_path"] != output.script_path
+			except OSError:
+				changed = True
+			wait = row["last"]+retry_delay(row["failures"])-time.time()
+
+			if changed:
+				status = "changed, retried next run"
+			elif limit > 0 and row["failures"] >= limit:
+				status = "quarantined"
+			elif wait > 0:
+				status = "retried in %dh%02dm" % (wait//3600, wait%3600//60)
+			else:
+				status = "retried next run"
+
+			target = " -> "+output.target if output is not None and output.id != 0 else ""
+			print "  ",row["path"]+target
+			print "     failed",row["failures"],"times, last "+time.strftime("%Y-%m-%d %H:%M", \
+				time.localtime(row["last"]))+", "+status
+			for line in (row["stderr"] or "").strip().splitlines()[-5:]:
+				print "       "+line
+		print "["+str(len(rows))+" total]"
+
 	# print the paths in a format that can be read in again using --import-paths
 	def export_paths(self):
-		for path in self.fetch_paths():
-			print "~~/"+path
+		c = dbc.execute("SELECT path FROM paths WHERE lid=? ORDER BY path ASC", (self.id,))
+		sys.stdout.writelines("~~/"+row["path"]+"\n" for row in c)
 
 	# checks a directory and optionally places in the libraries source dir
 	def check_path(self, path):
@@ -203,113 +1218,270 @@ class Library:
 	def scan(self, force=False):
 		tr = set()
 		cp = set()
-		tr_skip = 0
-		cp_skip = 0
 
+		for kind, src, dst, profile in self.scan_jobs(force):
+			if kind == "tr":
+				tr.add((src,dst))
+			else:
+				cp.add((src,dst))
+
+		return (tr, cp, self.skipped[0], self.skipped[1])
+
+	# scans the tracked paths, yielding ("tr" or "cp", src, dst, profile) for each output of a file
+	# that needs processing as soon as it is found. the outputs of a file are yielded together.
+	# the number of skipped (transcode, copy) files is kept in self.skipped.
+	def scan_jobs(self, force=False):
+		self.open_index()
+		for job in self.scan_files(force):
+			yield job
+		self.index.save()
+
+	# loads the tracked paths, output profiles and the file index ready for scan_files
+	def open_index(self):
 		if self.id >= 0:
 			self.fetch_paths()
+		self.outputs = self.fetch_profiles()
+		self.index = FileIndex(self)
 
-		for path in self.paths:
-			src = os.path.join(self.source, path)
+	# the part of scan_jobs that only touches the filesystem and not the database, so it can be run
+	# on another thread. missing target directories are made on the way unless create is off.
+	def scan_files(self, force=False, create=True):
+		self.skipped = [0, 0]
+		fast = Settings.properties["scanner"] == "scandir"
+		suffixes = self.suffix_map()
+		# target directories made by this scan, or None if they aren't made
+		made = set() if create else None
 
-			if os.path.isfile(src):
-				dst = os.path.join(self.target, path)
+		for path, isfile in self.scan_paths():
+			if isfile:
+				# a single tracked file is always processed, copied if it isn't a source file
+				found = [path]
+			elif fast:
+				for root, files in self.index.walk(path):
+					for job in self.scan_dir(root, files, suffixes, made, force):
+						yield job
+				continue
+			else:
+				found = (rel_join(root, f) for root, files in self.index.walk(path) \
+					for f in self.match_files(files))
 
-				if src[-len(self.exts[0]):] == self.exts[0]:
-					dst = dst[:-len(self.exts[0])]+self.exts[1]
-					if not os.path.isdir(os.path.dirname(dst)):
-						os.makedirs(os.path.dirname(dst))
-					
-					if not os.path.exists(dst) or force:
-						tr.add((src,dst))
-					else:
-						tr_skip += 1
-				else:
-					if not os.path.isdir(os.path.dirname(dst)):
-						os.makedirs(os.path.dirname(dst))
-					if not os.path.exists(dst) or force:
-						cp.add((src,dst))
-					else:
-						cp_skip += 1
+			for rel in found:
+				if rel in self.index.queued:
+					# already found through another tracked path
+					continue
+
+				s = os.path.join(self.source, rel)
+				kind = "tr" if s[-len(self.exts[0]):] == self.exts[0] else "cp"
+
+				for profile in self.outputs:
+					d = os.path.join(profile.target, rel)
+					if kind == "tr":
+						d = d[:-len(self.exts[0])]+profile.ext
+
+					if made is not None and not os.path.isdir(os.path.dirname(d)):
+						os.makedirs(os.path.dirname(d))
+
+					changed = self.index.changed(rel, d, force, pid=profile.id)
+					if changed:
+						yield (kind, s, d, profile)
+					elif changed is not None:
+						# held back files are counted apart
+						self.skipped[kind == "cp"] += 1
+
+	# the tracked paths to scan as (path, is a file) tuples. paths inside another tracked directory
+	# are left out, they are scanned with it, except for files the directory wouldn't pick up.
+	def scan_paths(self):
+		dirs = set()
+		paths = []
+		# parents sort before their children, so the tracked directories above a path are known
+		# by the time it comes up
+		for path in sorted(set(os.path.normpath(p) for p in self.paths)):
+			covered = "." in dirs
+			parent = path
+			while not covered and parent != "":
+				parent = os.path.dirname(parent)
+				covered = parent in dirs
+
+			isfile = os.path.isfile(os.path.join(self.source, path))
+			if not isfile:
+				if not covered:
+					dirs.add(path)
+					paths.append((path, False))
+			elif not covered or not self.match_files([os.path.basename(path)]):
+				paths.append((path, True))
+		return paths
+
+	# the source and copy files out of a directory listing
+	def match_files(self, files):
+		sf = fnmatch.filter(files, "*"+self.exts[0])
+
+		for c in self.cexts:
+			sf.extend(fnmatch.filter(files, "*"+c))
+
+		return sf
+
+	# maps file suffixes to "tr" or "cp" for the scandir scanner, so a file is classified with a
+	# single dictionary lookup. extensions that aren't a plain ".ext" suffix are returned separately
+	# to be matched with endswith.
+	def suffix_map(self):
+		simple = dict()
+		other = []
+		for ext, kind in [(self.exts[0], "tr")] + [(c, "cp") for c in self.cexts]:
+			if ext.startswith(".") and ext.count(".") == 1:
+				simple.setdefault(ext, kind)
 			else:
-				for root, dirs, files in os.walk(src):
-					files = [os.path.join(root, f) for f in files]
-					sf = fnmatch.filter(files, "*"+self.exts[0])
-
-					for c in self.cexts:
-						sf.extend(fnmatch.filter(files, "*"+c))
-
-					for s in sf:
-						d = os.path.join(self.target, os.path.relpath(s, self.source))
-
-						if s[-len(self.exts[0]):] == self.exts[0]:
-							d = d[:-len(self.exts[0])]+self.exts[1]
-							
-							if not os.path.isdir(os.path.dirname(d)):
-								os.makedirs(os.path.dirname(d))
-							
-							if not os.path.exists(d) or force:
-								tr.add((s,d))
-							else:
-								tr_skip += 1
-						else:
-							if not os.path.isdir(os.path.dirname(d)):
-								os.makedirs(os.path.dirname(d))
-							if not os.path.exists(d) or force:
-								cp.add((s,d))
-							else:
-								cp_skip += 1
-
-		return (tr, cp, tr_skip, cp_skip)
+				other.append((ext, kind))
+		return (simple, other)
 
-	# transcode everything that needs to be in the library
-	def transcode(self, workers, force=False):
-		print "scanning for files..."
-		tr, cp, tr_skip, cp_skip = self.scan(force)
-		tr = sorted(list(tr))
-		cp = sorted(list(cp))
-		print "Found:"
-		print "  transcode:",len(tr),"files ("+str(tr_skip)+" skipped)"
-		print "  copy:     ",len(cp),"files ("+str(cp_skip)+" skipped)"
+	# scans the files of a single source directory for the scandir scanner, yielding jobs like
+	# scan_jobs. instead of checking for every target file on its own each target directory is
+	# listed once.
+	def scan_dir(self, root, files, suffixes, made, force):
+		simple, other = suffixes
 
-		if Settings.properties["multithreaded"]:
-			p = workers.map_async(transcode_worker, [(self.script_path,)+p+(self.target,) for p in tr])
+		# paths are built by concatenation, os.path.join is slow enough to show up on big trees
+		prefix = rel_join(root, "")
+		sprefix = os.path.join(self.source, prefix)
+		# [profile, target dir, target prefix, listing] for each output, listed when first needed
+		outputs = []
+		for profile in self.outputs:
+			tdir = os.path.normpath(os.path.join(profile.target, root))
+			outputs.append([profile, tdir, os.path.join(tdir, ""), None])
+
+		for name in files:
+			kind = simple.get(name[name.rfind("."):])
+			if kind is None:
+				for ext, k in other:
+					if name.endswith(ext):
+						kind = k
+						break
+				else:
+					continue
+
+			rel = prefix+name
+			if rel in self.index.queued:
+				continue
+
+			for output in outputs:
+				profile, tdir, tprefix, existing = output
+				if existing is None:
+					existing = output[3] = self.target_listing(tdir, made)
+
+				if kind == "tr":
+					dname = name[:-len(self.exts[0])]+profile.ext
+				else:
+					dname = name
+
+				changed = self.index.changed(rel, tprefix+dname, force, dname in existing, profile.id)
+				if changed:
+					yield (kind, sprefix+name, tprefix+dname, profile)
+				elif changed is not None:
+					self.skipped[kind == "cp"] += 1
+
+	# the names in a target directory, creating the directory if it doesn't exist yet. made holds
+	# the directories created by this scan, which are known to be empty, or is None if directories
+	# aren't to be created.
+	def target_listing(self, tdir, made):
+		if made is None:
 			try:
-				p.get(0xffff)
-			except KeyboardInterrupt:
-				raise
+				return set(os.listdir(tdir))
+			except OSError:
+				return set()
+		if tdir in made:
+			# a directory is visited again through another tracked path
+			return set()
+		if os.path.dirname(tdir) in made:
+			os.mkdir(tdir)
 		else:
-			for src, dst in tr:
-				transcode_worker(self.script_path, src, dst, self.target)
+			try:
+				return set(os.listdir(tdir))
+			except OSError:
+				os.makedirs(tdir)
+		made.add(tdir)
+		return set()
 
-		for src, dst in cp:
-			shutil.copy2(src,dst)
-			print "c:",os.path.relpath(dst, self.target)
+	# transcode everything that needs to be in the library
+	def transcode(self, workers, force=False, stream=False, schedule=None):
+		RunPlanner([self], workers, force, stream, schedule, False).run()
 
-	# cleans the tree of unwanted files
-	def clean_tree(self):
-		for root, dirs, files in os.walk(self.target):
-			dirs = [os.path.join(root, d) for d in dirs]
-			files = [os.path.join(root, f) for f in files]
-			valid = fnmatch.filter(files, "*"+self.exts[1])
+	# removes the outputs made by earlier runs that no source in the last scan maps to any more,
+	# and the directories that leaves empty. returns the number of files removed.
+	def clean_orphans(self):
+		if not os.path.isdir(self.source):
+			# an unmounted source would make every output look orphaned
+			return 0
+		if self.index.unreadable > 0:
+			print >> sys.stderr, "Warning: Part of the source of '"+self.name+"' couldn't be read,", \
+				"leaving orphaned outputs alone until the next scan."
+			return 0
 
-			for c in self.cexts:
-				valid.extend(fnmatch.filter(files, "*"+c))
+		return self.remove_outputs(self.index.orphans())
 
-			rm_files = list(set(files) - set(valid))
-			for path in rm_files:
+	# removes outputs in the manifest and the directories that leaves empty. returns the number
+	# of files removed.
+	def remove_outputs(self, targets):
+		for path in targets:
+			try:
 				os.remove(path)
+			except OSError:
+				pass
 
-			for d in dirs:
+			d = os.path.dirname(path)
+			while d not in self.index.targets.values() and d != os.path.dirname(d):
 				try:
 					os.rmdir(d)
-				except OSError as ex:
-					pass
+				except OSError:
+					break
+				d = os.path.dirname(d)
+
+		self.index.drop_outputs(targets)
+		return len(targets)
+
+	# removes the outputs of deleted sources, given as (relpath, is a directory) tuples, with
+	# everything under the directories, and forgets the sources in the index. returns the number
+	# of files removed.
+	def remove_sources(self, removed):
+		files = set(rel for rel, isdir in removed)
+		dirs = set(rel for rel, isdir in removed if isdir)
+		targets = []
+		for dst, (pid, rel) in self.index.manifest.items():
+			parent = rel
+			while parent not in dirs and parent != "":
+				parent = os.path.dirname(parent)
+			if rel in files or parent != "":
+				targets.append(dst)
 
-	# write the progress
-	def write_progress(self):
-		sys.stdout.write("\rdone "+str(self.current)+" / "+str(self.items))
-		sys.stdout.flush()
+		for rel, isdir in removed:
+			self.index.forget(rel, isdir)
+		return self.remove_outputs(targets)
+
+	# deep clean. walks the trees of the output profiles removing every file without an extension
+	# the library makes and every empty directory. profiles sharing a target keep each other's
+	# files, and the target of a profile inside another one is left to that profile.
+	def clean_tree(self):
+		targets = dict()
+		for profile in self.outputs:
+			targets.setdefault(profile.target, list(self.cexts)).append(profile.ext)
+
+		for target, exts in targets.items():
+			for root, dirs, files in os.walk(target):
+				dirs[:] = [d for d in dirs if os.path.join(root, d) not in targets]
+				subdirs = [os.path.join(root, d) for d in dirs]
+				files = [os.path.join(root, f) for f in files]
+				valid = []
+
+				for e in exts:
+					valid.extend(fnmatch.filter(files, "*"+e))
+
+				rm_files = list(set(files) - set(valid))
+				for path in rm_files:
+					os.remove(path)
+
+				for d in subdirs:
+					try:
+						os.rmdir(d)
+					except OSError as ex:
+						pass
 
 	# encodes the library to a json string
 	def json_encode(self):
@@ -321,40 +1493,90 @@ class Library:
 		d["script_path"] = self.script_path
 		d["exts"] = self.exts
 		d["cexts"] = self.cexts
+		d["copy_mode"] = self.copy_mode
+		d["profiles"] = [{"target": p.target, "ext": p.ext, "script_path": p.script_path} \
+			for p in self.fetch_profiles()[1:]]
 		d["paths"] = self.fetch_paths()
 		return json.dumps(d, sort_keys=True, indent=4, separators=(',', ': '))
 
 	# decodes and updates this library from a json string
 	def json_decode(self, json_string):
-		d = json.loads(json_string)
+		self.decode(json.loads(json_string))
+
+	# updates this library from a decoded json object. the header of the streaming format has no
+	# paths, they follow it.
+	def decode(self, d):
 		self.name = d["name"]
 		self.source = d["source"]
 		self.target = d["target"]
-		self.paths = d["paths"]
 		self.script_path = d["script_path"]
 		self.exts = d["exts"]
 		self.cexts = d["cexts"]
-		self.paths = d["paths"]
+		self.copy_mode = d.get("copy_mode", Settings.properties["default_copy_mode"])
+		self.profiles = d.get("profiles", [])
+		self.paths = d.get("paths", [])
 
-	# save a library into the SQL database
-	def save(self):
+	# writes the library to out in the streaming format, a header record with everything but the
+	# paths followed by a record for each path, one json object a line. paths are written as they
+	# are read from the database, so a big library is never held in memory.
+	def export_lines(self, out):
+		d = dict()
+		d["format"] = Library.export_format
+		d["name"] = self.name
+		d["source"] = self.source
+		d["target"] = self.target
+		d["script_path"] = self.script_path
+		d["exts"] = self.exts
+		d["cexts"] = self.cexts
+		d["copy_mode"] = self.copy_mode
+		d["profiles"] = [{"target": p.target, "ext": p.ext, "script_path": p.script_path} \
+			for p in self.fetch_profiles()[1:]]
+		out.write(json.dumps(d, sort_keys=True)+"\n")
+		c = dbc.execute("SELECT path FROM paths WHERE lid=? ORDER BY path ASC", (self.id,))
+		out.writelines(json.dumps({"path": row["path"]})+"\n" for row in c)
+
+	# reads a library from fp and saves it. fp holds either the streaming format of export_lines,
+	# whose paths are loaded as they are read, or the json document of json_encode.
+	@staticmethod
+	def import_lines(fp):
+		lib = Library()
+		first = fp.readline()
+		try:
+			header = json.loads(first)
+		except ValueError:
+			header = None
+		if not isinstance(header, dict) or header.get("format") != Library.export_format:
+			lib.json_decode(first+fp.read())
+			lib.save()
+			return lib
+
+		lib.decode(header)
+		lib.save(json.loads(line)["path"] for line in fp if line.strip())
+		return lib
+
+	# save a library into the SQL database, with paths instead of self.paths if given. everything
+	# goes in a single transaction.
+	def save(self, paths=None):
 		try:
-			dbc.execute("INSERT INTO libraries VALUES (NULL,?,?,?,?,?,?,?)", (
+			dbc.execute("INSERT INTO libraries VALUES (NULL,?,?,?,?,?,?,?,?)", (
 				self.name,
 				self.source,
 				self.target,
 				self.script_path,
 				self.exts[0],
 				self.exts[1],
-				" ".join(self.cexts) ))
+				" ".join(self.cexts),
+				self.copy_mode ))
 			self.id = dbc.execute("SELECT id FROM libraries WHERE name=?", \
 				(self.name,)).fetchone()["id"]
-			dbc.commit()
 		except sqlite3.IntegrityError:
 			raise Library.AlreadyExists
 
-		for path in self.paths:
-			self.add_path(path, False)
+		dbc.executemany("INSERT OR IGNORE INTO paths VALUES (NULL,?,?)", \
+			((self.id, path) for path in (self.paths if paths is None else paths)))
+		for p in self.profiles:
+			self.add_profile(p["target"], p["ext"], p["script_path"], False)
+		dbc.commit()
 
 	# lists the names of all the libraries
 	@staticmethod
@@ -368,68 +1590,2499 @@ class Library:
 			lid = dbc.execute("SELECT id FROM libraries WHERE name=?", (name,)).fetchone()["id"]
 			dbc.execute("DELETE FROM libraries WHERE name=?", (name,))
 			dbc.execute("DELETE FROM paths WHERE lid=?", (lid,))
+			dbc.execute("DELETE FROM profiles WHERE lid=?", (lid,))
+			FileIndex.clear(lid)
 			dbc.commit()
 			print "Deleted library '"+name+"'."
 		except TypeError:
 			raise Library.NotFound
 
 
-#*		Public function, worker
+#*		RunPlanner
+#*	runs a set of libraries through one pool of workers. libraries are cleaned and scanned on
+#*	threads, one for each group of libraries with overlapping sources, and the jobs from all of them
+#*	share the pool so it doesn't go idle between libraries.
 #*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
-# worker thread to transcode a single item
-# tupe = (script_path, src, dst, drt)
-def transcode_worker(tupe):
-	try:
-		devnull = open('/dev/null', 'w')
-		p = subprocess.Popen([tupe[0],tupe[1],tupe[2]], stdout=devnull, stderr=devnull)
-		p.wait()
-		print "t:",os.path.relpath(tupe[2], tupe[3])
-	except KeyboardInterrupt:
-		pass
+class RunPlanner:
+	def __init__(self, libraries, workers, force=False, stream=False, schedule=None, clean=True, \
+			deep_clean=False, progress=None):
+		self.libraries = libraries
+		self.workers = workers
+		self.force = force
+		self.stream = stream
+		self.schedule = schedule or Settings.properties["schedule"]
+		self.clean = clean
+		self.deep_clean = deep_clean
+		self.results = []
+		self.history = JobHistory()
+		self.journal = Journal()
+		# Progress the jobs are reported to, if any
+		self.events = progress
+		self.flusher = None
+		if Settings.properties["staging_path"]:
+			self.flusher = Flusher(Settings.properties["staging_size"]*1024*1024, \
+				Settings.properties["flush_threads"])
+		# (library, [(src, dst, profile)], AsyncResult) of the jobs handed out and not collected yet
+		self.running = collections.deque()
+		self.copying = collections.deque()
+		# threads copying files, made when the run starts
+		self.copiers = None
+		# script path -> whether it is a batch script
+		self.batch = dict()
+		# target -> (library, (src, dst, profile), kind) of the jobs handed out whose encoder or copy
+		# hasn't started yet
+		self.pending = dict()
+		# targets of the copies that have started, the executors have a queue like it
+		self.starts = Queue.Queue()
 
-#*		Tool Commands
-#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
-# edit libraries
-def cmd_library(args):
-	if args.new:
-		# add a library
-		Library(args.new[0], args.new[1], args.new[2])
-	elif args.delete:
-		# deletes a library
-		Library.remove(args.delete)
-	elif args.script:
-		# set script path
-		name, path = args.script
-		Library(name).set_script_path(path)
-	elif args.source_ext:
-		# set source extension
-		name, ext = args.source_ext
-		Library(name).ext("source",ext)
-	elif args.target_ext:
-		# set target extension
-		name, ext = args.target_ext
-		Library(name).ext("target",ext)
-	elif args.add_copy:
-		# add copy extension
-		name, exts = args.add_copy
-		Library(name).ext("copy",append=exts.replace(",", " "))
-	elif args.clear_copy:
-		# remove all copy extensions
-		name = args.clear_copy
-		Library(name).ext("copy",set="")
-	elif args.export:
-		# export a library to json
-		print Library(args.export).json_encode()
-	elif args.import_lib:
-		# import a library from json
-		json = sys.stdin.read()
-		lib = Library()
-		lib.json_decode(json)
-		lib.save()
+	# groups libraries whose source trees overlap. groups are scanned at the same time, the
+	# libraries in a group one after another.
+	def groups(self):
+		groups = []
+		for lib in self.libraries:
+			sources = set([os.path.join(lib.source, "")])
+			members = [lib]
+			for g in list(groups):
+				if any(s.startswith(t) or t.startswith(s) for s in sources for t in g[0]):
+					sources |= g[0]
+					members = g[1]+members
+					groups.remove(g)
+			groups.append((sources, members))
+		return [g[1] for g in groups]
 
-# list libraries or paths of libraries
-def cmd_list(args):
-	if args.paths:
+	# scans and cleans a group of libraries on a scanning thread. every job goes on the queue as
+	# (library, kind, src, dst, profile), followed by (library, "scanned", None, None, None) once a
+	# library is done and (None, "done", exception, None, None) at the end of the group.
+	def scan_group(self, group, queue):
+		try:
+			listings = dict()
+			for lib in group:
+				lib.index.listings = listings
+				if self.deep_clean:
+					lib.clean_tree()
+				for job in lib.scan_files(self.force):
+					queue.put((lib,)+job)
+				# outputs are only cleaned up after a whole scan, a source found later could
+				# still map to them
+				lib.removed = lib.clean_orphans() if self.clean else 0
+				queue.put((lib, "scanned", None, None, None))
+		except Exception as e:
+			queue.put((None, "done", e, None, None))
+			return
+		queue.put((None, "done", None, None, None))
+
+	# runs everything. with stream set jobs are handed out as soon as they are found, otherwise
+	# once every library is scanned, in the order given by the schedule. if the run is interrupted
+	# what has been done so far is saved for the next run to carry on from.
+	def run(self):
+		try:
+			self.run_jobs()
+		except KeyboardInterrupt:
+			if self.copiers is not None:
+				self.copiers.terminate()
+			self.journal.flush()
+			if self.events is not None:
+				self.events.close()
+			# the index of a library still being scanned is left alone, what finished in it is
+			# in the journal
+			for lib in self.libraries:
+				if getattr(lib, "scanned", False):
+					lib.index.save()
+			self.history.save()
+			raise
+
+	def run_jobs(self):
+		self.copiers = ThreadPool(Settings.properties["copy_threads"])
+		for lib in self.libraries:
+			# a library that has been run before keeps its index
+			if getattr(lib, "index", None) is None:
+				lib.open_index()
+			else:
+				lib.index.begin()
+			self.journal.resume(lib)
+			lib.found = [0, 0]
+			lib.finished = [0, 0]
+			lib.failed = [0, 0]
+			lib.removed = 0
+			lib.scanned = False
+			# finished jobs wait here until the scan of their library is over, the index can't be
+			# touched from two threads at once
+			lib.unrecorded = []
+			# the outputs of a source found so far, they are all given to the workers together
+			lib.outputs_of = None
+
+		if self.stream:
+			print "scanning and transcoding..."
+			queue = Queue.Queue(Settings.properties["queue_size"])
+		else:
+			print "scanning for files..."
+			queue = Queue.Queue()
+
+		groups = self.groups()
+		for group in groups:
+			t = threading.Thread(target=self.scan_group, args=(group, queue))
+			t.daemon = True
+			t.start()
+
+		self.tr = []
+		cp = []
+		error = None
+		while len(groups) > 0:
+			lib, kind, src, dst, profile = queue.get(True, 0xffff)
+
+			if kind == "done":
+				groups.pop()
+				error = error or src
+			elif kind == "scanned":
+				self.add(lib)
+				self.scanned(lib)
+			elif kind == "tr":
+				lib.found[0] += 1
+				self.journal.update(lib, [(src, dst, profile)], "queued")
+				if self.events is not None:
+					self.events.queue(lib, [(src, dst, profile)], 0)
+				# the outputs of a source are found one after another
+				if lib.outputs_of is not None and lib.outputs_of[0] != src:
+					self.add(lib)
+				if lib.outputs_of is None:
+					lib.outputs_of = (src, [])
+				lib.outputs_of[1].append((profile, dst))
+			else:
+				lib.found[1] += 1
+				self.journal.update(lib, [(src, dst, profile)], "queued")
+				if self.events is not None:
+					self.events.queue(lib, [(src, dst, profile)], 1)
+				if self.stream:
+					self.submit_copy(lib, src, dst, profile)
+				else:
+					cp.append((lib, src, dst, profile))
+
+		if error is not None:
+			raise error
+
+		for job in cp:
+			self.submit_copy(*job)
+		for job in schedule_jobs(self.tr, self.schedule):
+			self.submit(*job)
+
+		while self.running:
+			self.collect(self.running)
+		while self.copying:
+			self.collect(self.copying)
+		self.copiers.close()
+		self.copiers.join()
+		if self.flusher is not None:
+			self.flusher.close()
+			self.flushed()
+		if self.events is not None:
+			self.events.close()
+
+		for lib in self.libraries:
+			lib.index.save()
+		self.history.save()
+		self.journal.clear(self.libraries)
+
+		if cache is not None:
+			cache.count(self.results)
+
+	# adds the source collected in lib.outputs_of as a transcode job
+	def add(self, lib):
+		if lib.outputs_of is None:
+			return
+		src, outputs = lib.outputs_of
+		lib.outputs_of = None
+
+		if self.stream:
+			self.submit(lib, src, outputs)
+		else:
+			self.tr.append((lib, src, outputs))
+
+	# a library has been scanned
+	def scanned(self, lib):
+		lib.scanned = True
+		self.record(lib, lib.unrecorded)
+		lib.unrecorded = []
+		lib.index.save()
+
+		if self.stream:
+			return
+		print "  [",lib.name,"]"
+		print "Found:"
+		print "  transcode:",lib.found[0],"files ("+str(lib.skipped[0])+" skipped)"
+		print "  copy:     ",lib.found[1],"files ("+str(lib.skipped[1])+" skipped)"
+		if lib.removed > 0:
+			print "  removed:  ",lib.removed,"orphaned files"
+		if lib.index.held > 0:
+			print "  held back:",lib.index.held,"failing files (see list --failed)"
+		self.progress(lib)
+
+	# hands a transcode job, a source and its [(profile, dst)] outputs, to the workers. in stream
+	# mode this waits while queue_size jobs are already out. sources with several outputs are
+	# read once for all of them, unless the fanout setting is off or their script is a batch
+	# script, which reads its sources by name. long wavs are split up for the outputs that can be
+	# joined back together.
+	def submit(self, lib, src, outputs):
+		layout = split_layout(src) if self.workers else None
+		if layout is not None:
+			for p, dst in [o for o in outputs if os.path.splitext(o[1])[1] in joinable_exts]:
+				outputs.remove((p, dst))
+				self.pending[dst] = (lib, (src, dst, p), 0)
+				self.reap(self.running)
+				self.running.append((lib, [(src, dst, p)], \
+					SplitJob(self.workers, (p.script_path, src, dst, p.target), layout)))
+			if not outputs:
+				return
+
+		fanout = []
+		if Settings.properties["fanout"]:
+			for p in set(p.script_path for p, dst in outputs) - set(self.batch):
+				self.batch[p] = is_batch_script(p)
+			fanout = [o for o in outputs if not self.batch[o[0].script_path]]
+			if len(fanout) < 2:
+				fanout = []
+
+		jobs = []
+		if fanout:
+			jobs.append(((src, [(p.script_path, dst, p.target) for p, dst in fanout]), \
+				[(src, dst, p) for p, dst in fanout], fanout_worker))
+		for p, dst in [o for o in outputs if o not in fanout]:
+			jobs.append(((p.script_path, src, dst, p.target), [(src, dst, p)], transcode_worker))
+
+		for tupe, rec, worker in jobs:
+			if not Settings.properties["multithreaded"]:
+				self.journal.update(lib, rec, "running")
+				if self.events is not None:
+					self.events.start(lib, rec, 0)
+				self.finished(lib, rec, 0, self.result(worker(tupe)))
+				continue
+
+			for r in rec:
+				self.pending[r[1]] = (lib, r, 0)
+
+			self.reap(self.running)
+			if worker is fanout_worker:
+				self.running.append((lib, rec, self.workers.submit_fanout(tupe)))
+			else:
+				self.running.append((lib, rec, self.workers.submit(tupe)))
+
+	# hands a copy job to the copy threads
+	def submit_copy(self, lib, src, dst, profile):
+		self.reap(self.copying)
+		self.pending[dst] = (lib, (src, dst, profile), 1)
+		self.copying.append((lib, [(src, dst, profile)], \
+			self.copiers.apply_async(self.copy, [(src, dst, profile.target, lib.copy_mode)])))
+
+	# runs a copy job on a copy thread
+	def copy(self, tupe):
+		self.starts.put(tupe[1])
+		return copy_worker(tupe)
+
+	# goes through the targets of the jobs that have started since last time. jobs are only
+	# journaled and counted as running from here, until then they are waiting on a free worker.
+	def started(self):
+		queues = [self.starts]
+		if self.workers:
+			queues.append(self.workers.starts)
+		for queue in queues:
+			while True:
+				try:
+					dst = queue.get_nowait()
+				except Queue.Empty:
+					break
+				# a segment of a split job, or a job of an earlier run in watch mode
+				if dst not in self.pending:
+					continue
+				lib, record, kind = self.pending.pop(dst)
+				self.journal.update(lib, [record], "running")
+				if self.events is not None:
+					self.events.start(lib, [record], kind)
+
+	# collects finished jobs from the front of a queue, and in stream mode makes room for another
+	def reap(self, jobs):
+		self.started()
+		if self.flusher is not None:
+			self.flushed()
+		while jobs and (jobs[0][2].ready() or \
+				(self.stream and len(jobs) >= Settings.properties["queue_size"])):
+			self.collect(jobs)
+
+	# waits for the oldest job in a queue to finish, keeping the progress snapshots coming. the
+	# jobs that start meanwhile are picked up, and the jobs of either queue that finish first are
+	# collected straight away so they don't look like they're still running.
+	def collect(self, jobs):
+		lib, records, p = jobs.popleft()
+		while not p.ready():
+			p.wait(Settings.properties["progress_interval"])
+			self.started()
+			for queue in (self.running, self.copying):
+				for job in [j for j in queue if j[2].ready()]:
+					queue.remove(job)
+					self.collected(queue, *job)
+			if self.events is not None:
+				self.events.tick()
+		self.collected(jobs, lib, records, p)
+
+	# hands the result of a finished job from one of the queues on
+	def collected(self, jobs, lib, records, p):
+		result = p.get(0xffff)
+		if jobs is self.running:
+			self.finished(lib, records, 0, self.result(result))
+		else:
+			self.finished(lib, records, 1, [result])
+
+	# the results of a transcode job as a list, one for each output. a fanout job gives a list
+	# already, a job that was interrupted gives None.
+	def result(self, result):
+		if not isinstance(result, list):
+			result = [result]
+		self.results.extend(r[0] for r in result if r is not None)
+		return result
+
+	# (src, dst, profile) records of a job have finished, with the results of the job. outputs the
+	# encoder or copy failed on are left out of the index so they are tried again, and their
+	# failure is recorded so they are held back for a while.
+	def finished(self, lib, records, kind, results):
+		# a job can finish before its start is picked up, or without starting at all if it was
+		# found in the cache
+		self.started()
+		for r in records:
+			self.pending.pop(r[1], None)
+		lib.finished[kind] += len(records)
+		if self.events is not None:
+			self.events.finish(lib, records, kind, results)
+		if kind == 0:
+			for (src, dst, profile), result in zip(records, results):
+				if result is not None:
+					self.history.add(lib, profile, src, dst, result)
+		# (src, dst, profile, stderr) for each output, stderr is None if it succeeded. interrupted
+		# jobs are neither done nor failed
+		outcomes = [r+(None if result[3] == 0 else result[6],) \
+			for r, result in zip(records, results) if result is not None]
+		failed = [r for r, result in zip(records, results) if result is None or result[3] != 0]
+		self.journal.update(lib, failed, "failed")
+		lib.failed[kind] += len(failed)
+		self.journal.update(lib, [o[:3] for o in outcomes if o[3] is None], "done")
+
+		# staged outputs are recorded once they have been flushed to their targets
+		if self.flusher is not None and kind == 0:
+			for o in [o for o in outcomes if o[3] is None and os.path.exists(staged_path(o[1]))]:
+				outcomes.remove(o)
+				self.flusher.add(o[1], (lib, o))
+
+		self.recorded(lib, outcomes)
+		self.progress(lib)
+
+	# records outcomes in the index, or keeps them until the scan of the library is over
+	def recorded(self, lib, outcomes):
+		if lib.scanned:
+			self.record(lib, outcomes)
+		else:
+			lib.unrecorded.extend(outcomes)
+
+	# records the outputs the flusher has moved to their targets. when staging is full this waits
+	# for room first.
+	def flushed(self):
+		while True:
+			try:
+				(lib, outcome), ok = self.flusher.done.get_nowait()
+				if ok:
+					self.recorded(lib, [outcome])
+			except Queue.Empty:
+				if not self.flusher.full():
+					return
+				self.flusher.wait()
+
+	# writes finished (src, dst, profile, stderr) outcomes to the index of a library
+	def record(self, lib, outcomes):
+		for src, dst, profile, stderr in outcomes:
+			if stderr is None:
+				lib.index.done([(src, dst)], profile.id)
+			else:
+				lib.index.failed([(src, stderr)], profile.id)
+
+	# prints a summary for a library once everything in it is finished
+	def progress(self, lib):
+		if lib.scanned and lib.finished == lib.found:
+			print "  [",lib.name,"] done:",lib.finished[0]-lib.failed[0],"transcoded,", \
+				lib.finished[1]-lib.failed[1],"copied,",sum(lib.failed),"failed,", \
+				sum(lib.skipped),"skipped"
+
+#*		ExecutorJob
+#*	a transcode job run by one of the executors in the transcoder process. works like the
+#*	AsyncResult of a pool job.
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+class ExecutorJob:
+	def __init__(self, tupe):
+		self.tupe = tupe
+		self.proc = None
+		self.key = None
+		self.started = None
+		self.stderr = []
+		self.returncode = None
+		self.timed_out = False
+		self.result = None
+		self.error = None
+		self.event = threading.Event()
+
+	def ready(self):
+		return self.event.is_set()
+
+	def wait(self, timeout=None):
+		self.event.wait(timeout)
+
+	def get(self, timeout=None):
+		self.event.wait(timeout)
+		if self.error is not None:
+			raise self.error
+		return self.result
+
+	# records how the encoder exited, reports it and wakes up anything waiting on the job
+	def finish(self, returncode, stderr=""):
+		returncode, error = commit_output(self.tupe, returncode)
+		self.returncode = returncode
+		self.stderr = stderr+error
+		report_job(self.tupe, returncode, self.stderr, self.timed_out)
+
+		self.result = job_result(self.tupe, cache_store(self.key, self.tupe, returncode), \
+			self.started, returncode, self.stderr)
+		self.event.set()
+
+	# marks the job as done with a result worked out elsewhere, or as failed if error is given
+	def skip(self, result=None, error=None):
+		self.result = result
+		self.error = error
+		self.event.set()
+
+#*		FanoutJob
+#*	the jobs for the outputs of one source that an executor runs together, reading the source once.
+#*	gives a list of their results, in the order of the outputs.
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+class FanoutJob:
+	def __init__(self, jobs):
+		self.jobs = jobs
+
+	def ready(self):
+		return all(job.ready() for job in self.jobs)
+
+	def wait(self, timeout=None):
+		for job in self.jobs:
+			if not job.ready():
+				job.wait(timeout)
+				return
+
+	def get(self, timeout=None):
+		return [job.get(timeout) for job in self.jobs]
+
+#*		PoolExecutor
+#*	runs transcode jobs on a multiprocessing pool, one python worker process per encoder.
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+class PoolExecutor:
+	def __init__(self, size):
+		self.size = size
+		# targets of the jobs the pool workers have started on
+		self.starts = multiprocessing.Queue()
+		self.pool = multiprocessing.Pool(size, pool_worker_init, (self.starts,))
+		# (worker, slots, job) of the jobs waiting for slots
+		self.waiting = collections.deque()
+		# encoders running, in the pool or lent out with acquire
+		self.busy = 0
+		self.cond = threading.Condition()
+
+	# starts a job, returning something with ready() and get(timeout) for its result
+	def submit(self, tupe):
+		return self.queue(transcode_worker, tupe, 1)
+
+	# starts a job that reads one source for several outputs. it runs an encoder for each output
+	# and takes a slot for each of them.
+	def submit_fanout(self, tupe):
+		return self.queue(fanout_worker, tupe, len(tupe[1]))
+
+	def queue(self, worker, tupe, slots):
+		job = ExecutorJob(tupe)
+		with self.cond:
+			self.waiting.append((worker, slots, job))
+			self.dispatch()
+		return job
+
+	# hands waiting jobs to the pool while there are slots for them, in order. a job that needs
+	# more slots than there are runs on its own.
+	def dispatch(self):
+		while self.waiting:
+			worker, slots, job = self.waiting[0]
+			if self.busy > 0 and self.busy+slots > self.size:
+				return
+			self.waiting.popleft()
+			self.busy += slots
+			self.pool.apply_async(pool_job, [worker, job.tupe], \
+				callback=lambda result, slots=slots, job=job: self.done(job, slots, result))
+
+	# a job has come back from the pool, on the pool's result thread
+	def done(self, job, slots, result):
+		self.release(slots)
+		job.skip(*result)
+
+	# takes a slot for an encoder run outside the pool, waiting for one to be free
+	def acquire(self):
+		with self.cond:
+			while self.busy >= self.size:
+				self.cond.wait(1.0)
+			self.busy += 1
+
+	def release(self, slots=1):
+		with self.cond:
+			self.busy -= slots
+			self.dispatch()
+			self.cond.notify_all()
+
+	def close(self):
+		pass
+
+	def join(self):
+		with self.cond:
+			while self.waiting:
+				self.cond.wait(1.0)
+		self.pool.close()
+		self.pool.join()
+
+	def terminate(self):
+		with self.cond:
+			self.waiting.clear()
+		self.pool.terminate()
+
+#*		ProcessExecutor
+#*	runs transcode jobs as encoder processes started straight from the transcoder, with no python
+#*	worker processes. a thread watches over the encoders with poll(), keeping at most size of them
+#*	running, collecting their stderr and killing any that go over the job timeout. the encoders of
+#*	a fanout job are started together and fed the source through fifos by a thread of their own.
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+class ProcessExecutor:
+	# how much of the end of an encoder's stderr is kept
+	stderr_size = 8192
+	# milliseconds between checks on encoders that have closed stderr but not exited
+	exit_poll = 50
+
+	def __init__(self, size, timeout=0, governor=None):
+		self.size = size
+		self.timeout = timeout
+		self.governor = governor
+		# lists of jobs to start together, one job or the outputs of a fanout job
+		self.waiting = collections.deque()
+		self.running = dict()
+		# jobs whose encoder has closed stderr but not yet exited
+		self.exiting = []
+		# encoders run outside the executor with a slot from acquire
+		self.lent = 0
+		self.closed = False
+		self.lock = threading.Condition()
+		# targets of the jobs whose encoder has started
+		self.starts = Queue.Queue()
+		# written to whenever there's something new for the watching thread to look at
+		self.wake_r, self.wake_w = os.pipe()
+		self.devnull = open(os.devnull, "r+")
+
+		self.thread = threading.Thread(target=self.loop)
+		self.thread.daemon = True
+		self.thread.start()
+
+	# the cache is looked up here rather than in the watching thread, which would stop reading
+	# stderr and checking timeouts while a source is hashed
+	def submit(self, tupe):
+		return self.queue([ExecutorJob(tupe)])[0]
+
+	# starts a job that reads one source for several outputs. tupe = (src, [(script, dst, drt)])
+	def submit_fanout(self, tupe):
+		src, outputs = tupe
+		return FanoutJob(self.queue([ExecutorJob((script, src, dst, drt)) \
+			for script, dst, drt in outputs]))
+
+	# queues jobs to be started together, apart from the cache hits
+	def queue(self, jobs):
+		group = []
+		for job in jobs:
+			job.key, hit = cache_lookup(job.tupe)
+			if hit:
+				job.skip(job_result(job.tupe, "hit", time.time(), 0))
+			else:
+				group.append(job)
+		if group:
+			with self.lock:
+				self.waiting.append(group)
+			os.write(self.wake_w, "j")
+		return jobs
+
+	# takes a slot for an encoder run outside the executor, waiting for one to be free
+	def acquire(self):
+		with self.lock:
+			while self.busy() >= self.size:
+				self.lock.wait(1.0)
+			self.lent += 1
+
+	def release(self):
+		with self.lock:
+			self.lent -= 1
+			self.lock.notify_all()
+		os.write(self.wake_w, "r")
+
+	# the encoders running, called with the lock held
+	def busy(self):
+		return len(self.running)+len(self.exiting)+self.lent
+
+	def close(self):
+		self.closed = True
+		os.write(self.wake_w, "c")
+
+	def join(self):
+		while self.thread.is_alive():
+			self.thread.join(0xffff)
+
+	# kills every running encoder. the watching thread changes running as it goes, so the jobs are
+	# taken under the lock.
+	def terminate(self):
+		with self.lock:
+			self.waiting.clear()
+			jobs = self.running.values()+self.exiting
+		for job in jobs:
+			kill_group(job.proc)
+			commit_output(job.tupe, -1)
+
+	# the watching thread
+	def loop(self):
+		poller = select.poll()
+		poller.register(self.wake_r, select.POLLIN)
+
+		while not (self.closed and not self.waiting and not self.running and not self.exiting):
+			self.start_jobs(poller)
+
+			wait = None
+			jobs = self.running.values()+self.exiting
+			if self.timeout > 0 and jobs:
+				first = min(job.started for job in jobs)
+				wait = max(0, int((first+self.timeout-time.time())*1000))+1
+			if self.exiting:
+				wait = min(wait, ProcessExecutor.exit_poll) if wait is not None \
+					else ProcessExecutor.exit_poll
+
+			try:
+				events = poller.poll(wait)
+			except select.error as e:
+				if e.args[0] == errno.EINTR:
+					continue
+				raise
+
+			for fd, event in events:
+				if fd == self.wake_r:
+					os.read(self.wake_r, 4096)
+					continue
+
+				data = os.read(fd, 65536)
+				job = self.running[fd]
+				if data:
+					job.stderr.append(data)
+					if sum(len(s) for s in job.stderr) > 2*ProcessExecutor.stderr_size:
+						job.stderr = ["".join(job.stderr)[-ProcessExecutor.stderr_size:]]
+				else:
+					# stderr closes when the encoder exits
+					poller.unregister(fd)
+					with self.lock:
+						del self.running[fd]
+						self.exiting.append(job)
+					job.proc.stderr.close()
+
+			for job in list(self.exiting):
+				returncode = self.reap(job)
+				if returncode is not None:
+					with self.lock:
+						self.exiting.remove(job)
+						self.lock.notify_all()
+					job.finish(returncode, "".join(job.stderr)[-ProcessExecutor.stderr_size:])
+
+			if self.timeout > 0:
+				for job in self.running.values()+self.exiting:
+					if not job.timed_out and time.time()-job.started > self.timeout:
+						job.timed_out = True
+						kill_group(job.proc)
+
+	# the exit status of the encoder of a job, or None if it hasn't exited yet. the cpu time it and
+	# its children used goes to the governor.
+	def reap(self, job):
+		while True:
+			try:
+				pid, status, usage = os.wait4(job.proc.pid, os.WNOHANG)
+				if pid == 0:
+					return None
+				break
+			except OSError as e:
+				if e.errno == errno.EINTR:
+					continue
+				# already reaped
+				return job.proc.wait()
+		if os.WIFSIGNALED(status):
+			job.proc.returncode = -os.WTERMSIG(status)
+		else:
+			job.proc.returncode = os.WEXITSTATUS(status)
+
+		if self.governor is not None:
+			self.governor.record(usage.ru_utime+usage.ru_stime, time.time()-job.started)
+			self.size = self.governor.adjust()
+		return job.proc.returncode
+
+	# starts waiting jobs in order until size encoders are running. the jobs of a fanout job are
+	# started together, on their own if there are more of them than size.
+	def start_jobs(self, poller):
+		while True:
+			with self.lock:
+				if not self.waiting:
+					return
+				group = self.waiting[0]
+				if self.busy() > 0 and self.busy()+len(group) > self.size:
+					return
+				self.waiting.popleft()
+
+			if len(group) == 1:
+				self.start(group[0], group[0].tupe[1], poller)
+				continue
+
+			# each encoder reads the source from a fifo, which keeps the name of the source as
+			# scripts may look at the extension
+			tmp = tempfile.mkdtemp(prefix="atran-")
+			fifos = []
+			for i, job in enumerate(group):
+				fifo = os.path.join(tmp, str(i)+"-"+os.path.basename(job.tupe[1]))
+				os.mkfifo(fifo)
+				if self.start(job, fifo, poller):
+					fifos.append((fifo, job.proc))
+			t = threading.Thread(target=feed_fifos, args=(group[0].tupe[1], fifos, tmp))
+			t.daemon = True
+			t.start()
+
+	# starts the encoder of a job on a source, returning whether it started
+	def start(self, job, source, poller):
+		job.started = time.time()
+		try:
+			# each encoder gets its own process group so it can be killed with its children
+			job.proc = subprocess.Popen([job.tupe[0],source,work_path(job.tupe[2])], \
+				stdin=self.devnull, stdout=self.devnull, stderr=subprocess.PIPE, close_fds=True, \
+				preexec_fn=encoder_init)
+		except OSError as e:
+			job.skip(error=e)
+			return False
+
+		with self.lock:
+			self.running[job.proc.stderr.fileno()] = job
+		poller.register(job.proc.stderr.fileno(), select.POLLIN)
+		self.starts.put(job.tupe[2])
+		return True
+
+#*		Governor
+#*	grows and shrinks the number of encoders the process executor runs at once, between min_cores
+#*	and max_cores. the cpu time of every finished encoder is measured against its wall time, which
+#*	tells how many cpus an encoder keeps busy, and the idle time of the machine's cpus is read
+#*	from /proc/stat. encoders that spend their time waiting on a slow source leave cpus idle, so
+#*	more of them are run. encoders that get less than a cpu each while none are idle are fighting
+#*	over them, so fewer are run. what the load average shows beyond the encoders is taken to be
+#*	other work on the machine, and the encoders are kept to what that leaves of max_load. the size
+#*	moves one step at a time, at most once every interval seconds.
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+class Governor:
+	interval = 10.0
+
+	def __init__(self, size, low, high):
+		self.low = max(1, low)
+		self.high = max(self.low, high)
+		self.size = min(max(size, self.low), self.high)
+		self.cpus = multiprocessing.cpu_count()
+		self.begin()
+
+	# starts measuring for the next change
+	def begin(self):
+		# cpu and wall seconds of the encoders finished since then
+		self.cpu = 0.0
+		self.wall = 0.0
+		self.changed = time.time()
+		self.times = cpu_times()
+
+	def record(self, cpu, wall):
+		self.cpu += cpu
+		self.wall += wall
+
+	# the number of encoders to run from now on
+	def adjust(self):
+		if time.time()-self.changed < Governor.interval or self.wall <= 0:
+			return self.size
+
+		# cpus each encoder keeps busy, and cpus left idle
+		busy = max(0.05, self.cpu/self.wall)
+		load = os.getloadavg()[0]
+		times = cpu_times()
+		if times is not None and self.times is not None and times[1] > self.times[1]:
+			idle = self.cpus*float(times[0]-self.times[0])/(times[1]-self.times[1])
+		else:
+			idle = max(0.0, self.cpus-load)
+		# the encoders are in the load average whether they are running or waiting on a read
+		demand = max(0.0, load-self.size)+self.size*busy
+		limit = Settings.properties["max_load"] or self.cpus
+
+		if demand > limit or (idle < 0.5 and busy < 0.9):
+			self.size = max(self.size-1, self.low)
+		elif idle >= busy and demand+busy <= limit:
+			self.size = min(self.size+1, self.high)
+
+		self.begin()
+		return self.size
+
+#*		BatchExecutor
+#*	keeps encoder scripts that speak the batch protocol running for the whole run, instead of
+#*	starting the script once per file. a batch script has "atran-protocol: batch" in a comment near
+#*	the top and is started with the single argument --batch. it reads jobs from stdin as a line with
+#*	the source path followed by a line with the target path, and after each job writes a line with
+#*	the exit status of the job and the target path to stdout. jobs for other scripts are passed on
+#*	to the normal executor, which batch encoders also take a slot from for each job they work on.
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+class BatchExecutor:
+	def __init__(self, size, fallback, timeout=0):
+		self.size = size
+		self.fallback = fallback
+		self.timeout = timeout
+		# script path -> whether it is a batch script
+		self.batch = dict()
+		# script path -> queue of jobs for its workers
+		self.queues = dict()
+		self.threads = []
+		# the worker threads change procs and active as they go, terminate takes them under the lock
+		self.lock = threading.Lock()
+		self.procs = set()
+		# jobs a batch encoder is working on
+		self.active = set()
+		self.terminated = False
+		# shared with the fallback executor, jobs start on either
+		self.starts = fallback.starts
+
+	def submit(self, tupe):
+		script = tupe[0]
+		if script not in self.batch:
+			self.batch[script] = is_batch_script(script)
+
+		# the protocol is line based, so paths with newlines in go to the normal executor
+		if not self.batch[script] or "\n" in tupe[1]+tupe[2]:
+			return self.fallback.submit(tupe)
+
+		if script not in self.queues:
+			self.queues[script] = Queue.Queue()
+			for i in range(self.size):
+				t = threading.Thread(target=self.worker, args=(script, self.queues[script]))
+				t.daemon = True
+				t.start()
+				self.threads.append(t)
+
+		job = ExecutorJob(tupe)
+		self.queues[script].put(job)
+		return job
+
+	# a batch encoder reads its sources by name, so fanout jobs go to the normal executor
+	def submit_fanout(self, tupe):
+		return self.fallback.submit_fanout(tupe)
+
+	def close(self):
+		for queue in self.queues.values():
+			for t in range(self.size):
+				queue.put(None)
+		self.fallback.close()
+
+	def join(self):
+		for t in self.threads:
+			while t.is_alive():
+				t.join(0xffff)
+		self.fallback.join()
+
+	def terminate(self):
+		with self.lock:
+			self.terminated = True
+			procs = list(self.procs)
+			active = list(self.active)
+		for proc in procs:
+			kill_group(proc)
+		for job in active:
+			commit_output(job.tupe, -1)
+		self.fallback.terminate()
+
+	# looks after one long running encoder, feeding it jobs from the queue until it gets None
+	# the stderr of the encoder goes to a file, what it writes while working on a job is taken to
+	# be about that job.
+	def worker(self, script, queue):
+		proc = None
+		err = tempfile.TemporaryFile("a+b")
+		while True:
+			job = queue.get()
+			if job is None:
+				break
+
+			job.key, hit = cache_lookup(job.tupe)
+			if hit:
+				job.skip(job_result(job.tupe, "hit", time.time(), 0))
+				continue
+
+			self.fallback.acquire()
+			try:
+				proc = self.run_job(script, proc, err, job)
+			finally:
+				self.fallback.release()
+			if self.terminated:
+				break
+
+			# only the end is ever read, so the file is emptied between jobs once it gets big. it
+			# is opened for appending, the encoder carries on writing from the new end.
+			if err.tell() > 16*ProcessExecutor.stderr_size:
+				err.truncate(0)
+
+		if proc is not None:
+			self.stop(proc)
+		err.close()
+
+	# hands a job to the batch encoder proc, starting one if it's None, and returns the encoder to
+	# use for the next job. an encoder that goes over the job timeout is killed.
+	def run_job(self, script, proc, err, job):
+		with self.lock:
+			if self.terminated:
+				job.skip()
+				return proc
+			try:
+				if proc is None:
+					# in a process group of its own, so it can be killed with its children
+					proc = subprocess.Popen([script, "--batch"], stdin=subprocess.PIPE, \
+						stdout=subprocess.PIPE, stderr=err, close_fds=True, preexec_fn=encoder_init)
+					self.procs.add(proc)
+			except OSError as e:
+				job.skip(error=e)
+				return None
+			job.started = time.time()
+			self.active.add(job)
+		self.starts.put(job.tupe[2])
+
+		err.seek(0, os.SEEK_END)
+		offset = err.tell()
+		try:
+			proc.stdin.write(job.tupe[1]+"\n"+work_path(job.tupe[2])+"\n")
+			proc.stdin.flush()
+			if self.timeout > 0 and not select.select([proc.stdout], [], [], self.timeout)[0]:
+				job.timed_out = True
+				kill_group(proc)
+			reply = proc.stdout.readline()
+		except IOError:
+			reply = ""
+
+		returncode, error = batch_status(reply, None)
+		if error:
+			# the encoder died or isn't following the protocol, start a new one for the next job
+			self.stop(proc)
+			returncode, error = batch_status(reply, proc.returncode)
+			proc = None
+		job.finish(returncode, read_tail(err, offset)+error)
+		with self.lock:
+			self.active.discard(job)
+		return proc
+
+	# closes the stdin of a batch encoder and waits for it to exit
+	def stop(self, proc):
+		try:
+			proc.stdin.close()
+		except IOError:
+			pass
+		if proc.poll() is None:
+			time.sleep(0.1)
+			if proc.poll() is None:
+				kill_group(proc)
+		proc.wait()
+		with self.lock:
+			self.procs.discard(proc)
+
+#*		SplitJob
+#*	a transcode job for a long wav source. the source is cut into segments that are encoded on the
+#*	workers side by side, and the outputs are joined and checked against the length of the source.
+#*	works like the AsyncResult of a pool job.
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+class SplitJob:
+	# how far in seconds the joined output may be from the source for each segment, encoders pad
+	# the start and end of what they are given
+	tolerance = 0.1
+
+	def __init__(self, workers, tupe, layout):
+		self.workers = workers
+		self.tupe = tupe
+		self.layout = layout
+		self.result = None
+		self.error = None
+		self.event = threading.Event()
+
+		t = threading.Thread(target=self.run)
+		t.daemon = True
+		t.start()
+
+	def ready(self):
+		return self.event.is_set()
+
+	def wait(self, timeout=None):
+		self.event.wait(timeout)
+
+	def get(self, timeout=None):
+		self.event.wait(timeout)
+		if self.error is not None:
+			raise self.error
+		return self.result
+
+	def run(self):
+		try:
+			self.result = self.transcode()
+		except (IOError, OSError) as e:
+			report_job(self.tupe, -1, str(e))
+			self.result = job_result(self.tupe, None, time.time(), -1, str(e))
+		except Exception as e:
+			self.error = e
+		self.event.set()
+
+	# returns the job result like transcode_worker. if the joined output doesn't come out the
+	# length of the source the source is encoded again in one go.
+	def transcode(self):
+		script, src, dst, drt = self.tupe
+		start = time.time()
+		key, hit = cache_lookup(self.tupe)
+		if hit:
+			return job_result(self.tupe, "hit", start, 0)
+
+		self.workers.starts.put(dst)
+		fmt, duration, segments = self.layout
+		parts = parts_path(dst)
+		shutil.rmtree(parts, True)
+		os.mkdir(parts)
+		try:
+			outputs = []
+			jobs = []
+			fd = os.open(src, os.O_RDONLY)
+			try:
+				# each segment is handed out as soon as it is written
+				for i, (offset, size) in enumerate(segments):
+					seg = os.path.join(parts, "%03d-" % i+os.path.basename(src))
+					out = os.path.join(parts, "%03d-" % i+os.path.basename(dst))
+					write_segment(fd, seg, fmt, offset, size)
+					jobs.append(self.workers.submit((script, seg, out, None)))
+					# with staging on the encoded segments are left in the staging directory
+					outputs.append(staged_path(out) or out)
+			finally:
+				os.close(fd)
+
+			# every segment is waited for before the parts are removed, even once one has failed
+			results = [job.get(0xffff) for job in jobs]
+			for result in results:
+				if result is None:
+					return None
+				elif result[3] != 0:
+					report_job(self.tupe, result[3], result[6])
+					return job_result(self.tupe, None, start, result[3], result[6])
+
+			out = os.open(work_path(dst), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+			try:
+				for path in outputs:
+					fd = os.open(path, os.O_RDONLY)
+					try:
+						copy_range(fd, out, 0, os.fstat(fd).st_size)
+					finally:
+						os.close(fd)
+			finally:
+				os.close(out)
+		finally:
+			shutil.rmtree(parts, True)
+			for path in outputs:
+				if os.path.exists(path):
+					os.remove(path)
+
+		length = encoded_duration(work_path(dst))
+		if length is None or abs(length-duration) > SplitJob.tolerance*len(segments):
+			commit_output(self.tupe, -1)
+			print >> sys.stderr, "Error: Joined segments of '"+os.path.relpath(dst, drt)+"' are", \
+				"%.2fs long instead of %.2fs, encoding it whole" % (length or 0, duration)
+			return self.workers.submit(self.tupe).get(0xffff)
+
+		returncode, error = commit_output(self.tupe, 0)
+		report_job(self.tupe, returncode, error)
+		return job_result(self.tupe, cache_store(key, self.tupe, returncode), start, returncode, \
+			error)
+
+#*		JobServer
+#*	hands transcode jobs out to atran worker processes over a tcp or unix socket, so machines that
+#*	see the libraries at the same paths can share a run. a worker asks for one job at a time and
+#*	holds a lease on it, which it renews while its encoder runs. the jobs of a worker that goes away
+#*	or stops renewing are handed out again. each lease has an output of its own, so a worker that
+#*	turns up late can't clobber the one that took over. messages are a json object a line both ways
+#*	and there's no authentication, only listen where the workers can be trusted.
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+class JobServer:
+	def __init__(self, address, lease_time):
+		self.address = address
+		self.lease_time = lease_time
+		self.waiting = collections.deque()
+		# lease -> [job, time the lease runs out] of the jobs out with workers
+		self.leases = dict()
+		# lease -> output of leases that ran out, removed if their worker turns up again
+		self.lost = dict()
+		self.next_lease = 0
+		# workers connected
+		self.connections = 0
+		# connection -> thread talking to the worker on it
+		self.serving = dict()
+		self.closed = False
+		self.stopped = False
+		self.cond = threading.Condition()
+		# targets of the jobs handed to workers
+		self.starts = Queue.Queue()
+
+		family, self.path = parse_address(address)
+		self.sock = socket.socket(family, socket.SOCK_STREAM)
+		if family == socket.AF_UNIX:
+			# the socket of a server that didn't get to clean up
+			if os.path.exists(self.path):
+				os.remove(self.path)
+		else:
+			self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.sock.bind(self.path)
+		self.sock.listen(64)
+
+		self.thread = threading.Thread(target=self.accept)
+		self.thread.daemon = True
+		self.thread.start()
+		self.expirer = threading.Thread(target=self.watch)
+		self.expirer.daemon = True
+		self.expirer.start()
+
+	# the cache is looked up here, as in the process executor, so no source is hashed while the
+	# lock is held
+	def submit(self, tupe):
+		job = ExecutorJob(tupe)
+		job.key, hit = cache_lookup(tupe)
+		if hit:
+			job.skip(job_result(tupe, "hit", time.time(), 0))
+			return job
+		with self.cond:
+			self.waiting.append(job)
+			self.cond.notify_all()
+		return job
+
+	def close(self):
+		with self.cond:
+			self.closed = True
+			self.cond.notify_all()
+
+	# waits for every job to finish, then stops listening once the workers have been told there's
+	# nothing left, or have had a while to ask
+	def join(self):
+		with self.cond:
+			while self.waiting or self.leases:
+				self.cond.wait(1.0)
+			end = time.time()+self.lease_time/3.0
+			while self.connections > 0 and time.time() < end:
+				self.cond.wait(0.1)
+		self.stop()
+
+	def terminate(self):
+		with self.cond:
+			self.closed = True
+			self.waiting.clear()
+			for lease, (job, expires) in self.leases.items():
+				commit_output(job.tupe, -1)
+				self.remove(lease_path(job.tupe[2], lease))
+			self.leases.clear()
+			self.cond.notify_all()
+		self.stop()
+
+	# stops listening and cuts off the workers still connected. the threads are waited for, left
+	# running they could still be in the middle of something as the interpreter shuts down.
+	def stop(self):
+		with self.cond:
+			self.stopped = True
+			self.cond.notify_all()
+		self.expirer.join()
+		JobServer.shutdown(self.sock)
+		self.sock.close()
+		self.thread.join()
+		with self.cond:
+			serving = self.serving.items()
+		for conn, t in serving:
+			JobServer.shutdown(conn)
+			t.join()
+		if isinstance(self.path, basestring) and os.path.exists(self.path):
+			os.remove(self.path)
+
+	@staticmethod
+	def shutdown(sock):
+		try:
+			sock.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+
+	def accept(self):
+		while True:
+			try:
+				conn = self.sock.accept()[0]
+			except socket.error:
+				return
+			t = threading.Thread(target=self.serve, args=(conn,))
+			t.daemon = True
+			with self.cond:
+				self.serving[conn] = t
+			t.start()
+
+	# talks to one worker until it goes away, when the jobs it still had go back in the queue
+	def serve(self, conn):
+		held = set()
+		with self.cond:
+			self.connections += 1
+		try:
+			rfile = conn.makefile("rb")
+			for line in iter(rfile.readline, ""):
+				msg = json.loads(line)
+				if msg["op"] == "get":
+					reply = self.take(held)
+				elif msg["op"] == "renew":
+					reply = self.renew(msg["lease"])
+				else:
+					reply = self.result(msg["lease"], int(msg["status"]), msg.get("stderr", ""))
+					held.discard(msg["lease"])
+				conn.sendall(json.dumps(reply)+"\n")
+				if reply["op"] == "exit":
+					break
+		except (socket.error, ValueError, KeyError):
+			pass
+		finally:
+			with self.cond:
+				self.connections -= 1
+				self.serving.pop(conn, None)
+				for lease in held:
+					if lease in self.leases:
+						self.requeue(lease)
+				self.cond.notify_all()
+			conn.close()
+
+	# gives the next job to a worker, waiting for one if there's none yet. a worker is let go once
+	# the queue is closed and every job has finished.
+	def take(self, held):
+		with self.cond:
+			while True:
+				self.expire()
+				if self.waiting:
+					job = self.waiting.popleft()
+					break
+				if self.closed and not self.leases:
+					return {"op": "exit"}
+				self.cond.wait(1.0)
+
+			lease = self.next_lease
+			self.next_lease += 1
+			self.leases[lease] = [job, time.time()+self.lease_time]
+			held.add(lease)
+			job.started = time.time()
+			self.starts.put(job.tupe[2])
+			return {"op": "job", "lease": lease, "script": job.tupe[0], "source": job.tupe[1],
+				"output": lease_path(job.tupe[2], lease), "renew": self.lease_time/3.0}
+
+	def renew(self, lease):
+		with self.cond:
+			if lease not in self.leases:
+				return {"op": "renew", "ok": False}
+			self.leases[lease][1] = time.time()+self.lease_time
+			return {"op": "renew", "ok": True}
+
+	# a worker is done with a job. the output of a lease that ran out is thrown away.
+	def result(self, lease, returncode, stderr):
+		with self.cond:
+			if lease not in self.leases:
+				self.remove(self.lost.pop(lease, None))
+				return {"op": "result", "ok": False}
+			job = self.leases.pop(lease)[0]
+
+		tmp = lease_path(job.tupe[2], lease)
+		if returncode == 0:
+			try:
+				os.rename(tmp, work_path(job.tupe[2]))
+			except OSError:
+				pass
+		else:
+			self.remove(tmp)
+		job.finish(returncode, stderr)
+
+		with self.cond:
+			self.cond.notify_all()
+		return {"op": "result", "ok": True}
+
+	# looks for leases that have run out every so often. the planner waits on the jobs without
+	# asking the server, so the job of a worker that hangs would never come back if this was left
+	# to the workers asking for jobs.
+	def watch(self):
+		with self.cond:
+			while not self.stopped:
+				self.expire()
+				self.cond.wait(self.lease_time/3.0)
+
+	# puts the jobs whose leases have run out back in the queue, called with the lock held
+	def expire(self):
+		now = time.time()
+		for lease, (job, expires) in self.leases.items():
+			if expires < now:
+				print >> sys.stderr, "Warning: Lost the worker transcoding '"+ \
+					os.path.relpath(job.tupe[2], job.tupe[3])+"', handing it out again."
+				self.requeue(lease)
+
+	def requeue(self, lease):
+		job = self.leases.pop(lease)[0]
+		self.lost[lease] = lease_path(job.tupe[2], lease)
+		self.remove(self.lost[lease])
+		self.waiting.appendleft(job)
+		self.cond.notify_all()
+
+	@staticmethod
+	def remove(path):
+		try:
+			if path is not None:
+				os.remove(path)
+		except OSError:
+			pass
+
+#*		RemoteWorker
+#*	the other end of a JobServer, run by atran worker. takes jobs from the server one at a time,
+#*	runs the encoder script on each and sends back how it went, renewing the lease on the job while
+#*	the encoder runs. a server that isn't up yet is waited for.
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+class RemoteWorker:
+	# seconds between attempts to reach the server
+	retry = 2.0
+
+	def __init__(self, address):
+		self.address = address
+		self.sock = None
+		self.proc = None
+		self.stopping = False
+		# script path -> whether it is a batch script
+		self.batch = dict()
+
+	# returns False if the worker was stopped before it got through
+	def connect(self):
+		family, path = parse_address(self.address)
+		while not self.stopping:
+			self.sock = socket.socket(family, socket.SOCK_STREAM)
+			try:
+				self.sock.connect(path)
+				self.rfile = self.sock.makefile("rb")
+				return True
+			except socket.error:
+				self.sock.close()
+				time.sleep(RemoteWorker.retry)
+		return False
+
+	# sends a message to the server and waits for its reply
+	def call(self, msg):
+		self.sock.sendall(json.dumps(msg)+"\n")
+		line = self.rfile.readline()
+		if not line:
+			raise socket.error("connection closed by the server")
+		return json.loads(line)
+
+	# runs jobs until the server has none left or goes away
+	def run(self):
+		if not self.connect():
+			return
+		try:
+			while not self.stopping:
+				job = self.call({"op": "get"})
+				if job["op"] == "exit":
+					return
+				result = self.encode(job)
+				if result is not None:
+					self.call({"op": "result", "lease": job["lease"], "status": result[0],
+						"stderr": result[1]})
+		except socket.error as e:
+			if not self.stopping:
+				print >> sys.stderr, "Error: Lost the connection to the server: "+str(e)
+		finally:
+			self.sock.close()
+
+	# kills the encoder and drops the connection, which ends run()
+	def halt(self):
+		self.stopping = True
+		proc = self.proc
+		if proc is not None:
+			kill_group(proc)
+		if self.sock is not None:
+			JobServer.shutdown(self.sock)
+
+	# runs the encoder of a job, returning (exit status, end of its stderr). None if the server
+	# took the job back, the encoder is stopped then. a batch script is started for the one job,
+	# which it reads from stdin, and gives its status on stdout.
+	def encode(self, job):
+		script = job["script"]
+		if script not in self.batch:
+			self.batch[script] = is_batch_script(script)
+		batch = self.batch[script]
+		if batch and "\n" in job["source"]+job["output"]:
+			return (-1, "a batch script can't be given paths with newlines")
+
+		devnull = open(os.devnull, "r+")
+		try:
+			if batch:
+				self.proc = subprocess.Popen([script, "--batch"], stdin=subprocess.PIPE, \
+					stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, \
+					preexec_fn=RemoteWorker.encoder_init)
+			else:
+				self.proc = subprocess.Popen([script, job["source"], job["output"]], \
+					stdin=devnull, stdout=devnull, stderr=subprocess.PIPE, close_fds=True, \
+					preexec_fn=RemoteWorker.encoder_init)
+		except OSError as e:
+			return (-1, str(e))
+		finally:
+			devnull.close()
+		if self.stopping:
+			# halted while the encoder was starting
+			kill_group(self.proc)
+
+		stderr = ""
+		reply = ""
+		renewed = time.time()
+		try:
+			if batch:
+				try:
+					self.proc.stdin.write(job["source"]+"\n"+job["output"]+"\n")
+					self.proc.stdin.close()
+				except IOError:
+					pass
+			# a batch encoder exits once it has read to the end of stdin
+			pipes = [self.proc.stderr]+([self.proc.stdout] if batch else [])
+			while pipes:
+				for pipe in select.select(pipes, [], [], job["renew"])[0]:
+					data = os.read(pipe.fileno(), 65536)
+					if not data:
+						pipes.remove(pipe)
+					elif pipe is self.proc.stderr:
+						stderr = (stderr+data)[-ProcessExecutor.stderr_size:]
+					else:
+						reply += data
+				if time.time()-renewed >= job["renew"]:
+					renewed = time.time()
+					if not self.call({"op": "renew", "lease": job["lease"]})["ok"]:
+						self.stop(job)
+						return None
+			returncode = self.proc.wait()
+			if batch:
+				returncode, error = batch_status(reply, returncode)
+				stderr += error
+			return (returncode, stderr)
+		finally:
+			if self.proc.poll() is None:
+				self.stop(job)
+			self.proc.stderr.close()
+			if batch:
+				self.proc.stdout.close()
+			self.proc = None
+
+	# sets up an encoder process. it gets a process group of its own, and on linux is killed if the
+	# worker dies without stopping it, rather than writing an output the server has given up on.
+	@staticmethod
+	def encoder_init():
+		encoder_init()
+		if libc is not None and hasattr(libc, "prctl"):
+			# PR_SET_PDEATHSIG
+			libc.prctl(1, signal.SIGKILL)
+
+	# kills the encoder of a job and removes what it wrote
+	def stop(self, job):
+		kill_group(self.proc)
+		self.proc.wait()
+		JobServer.remove(job["output"])
+
+#*		Watcher
+#*	watches the tracked paths of libraries with inotify for source files being written, moved in
+#*	or deleted. a changed file is held back until nothing has happened to it for watch_delay
+#*	seconds, so files being copied in aren't picked up half written.
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+class Watcher:
+	IN_MODIFY = 0x2
+	IN_CLOSE_WRITE = 0x8
+	IN_MOVED_FROM = 0x40
+	IN_MOVED_TO = 0x80
+	IN_CREATE = 0x100
+	IN_DELETE = 0x200
+	IN_Q_OVERFLOW = 0x4000
+	IN_IGNORED = 0x8000
+	IN_ONLYDIR = 0x1000000
+	IN_ISDIR = 0x40000000
+
+	mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+		IN_ONLYDIR
+
+	def __init__(self, libraries):
+		if libc is None or not hasattr(libc, "inotify_init"):
+			raise OSError("inotify isn't available")
+		self.fd = libc.inotify_init()
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+		# watch descriptor -> directory
+		self.dirs = dict()
+		# path -> time of its last event, for changed files
+		self.changed = dict()
+		# path -> whether it was a directory, for removed paths
+		self.removed = dict()
+		# set when the kernel dropped events, everything has to be scanned again
+		self.overflow = False
+		# library -> (path, is a file) of its tracked paths
+		self.tracked = dict()
+
+		for lib in libraries:
+			self.tracked[lib] = lib.scan_paths()
+			for path, isfile in self.tracked[lib]:
+				path = os.path.normpath(os.path.join(lib.source, path))
+				if isfile:
+					self.add(os.path.dirname(path))
+				else:
+					self.add_tree(path)
+
+	def close(self):
+		os.close(self.fd)
+
+	def add(self, path):
+		# ctypes would pass unicode as a wide string
+		if isinstance(path, unicode):
+			path = path.encode(sys.getfilesystemencoding() or "utf-8")
+		wd = libc.inotify_add_watch(self.fd, path, Watcher.mask)
+		if wd >= 0:
+			self.dirs[wd] = path
+		elif ctypes.get_errno() == errno.ENOSPC:
+			raise OSError(errno.ENOSPC, "out of inotify watches, see fs.inotify.max_user_watches")
+
+	# watches a directory and everything under it. returns the files found in it.
+	def add_tree(self, top):
+		found = []
+		for root, dirs, files in os.walk(top):
+			self.add(root)
+			found.extend(os.path.join(root, f) for f in files)
+		return found
+
+	# waits up to timeout seconds, or for good with None, for events and takes them in
+	def read(self, timeout):
+		try:
+			if not select.select([self.fd], [], [], timeout)[0]:
+				return
+		except select.error as e:
+			if e[0] != errno.EINTR:
+				raise
+			return
+
+		data = os.read(self.fd, 65536)
+		i = 0
+		while i+16 <= len(data):
+			wd, mask, cookie, size = struct.unpack("iIII", data[i:i+16])
+			self.event(wd, mask, data[i+16:i+16+size].rstrip("\0"))
+			i += 16+size
+
+	def event(self, wd, mask, name):
+		if mask & Watcher.IN_Q_OVERFLOW:
+			self.overflow = True
+			return
+		elif mask & Watcher.IN_IGNORED:
+			# the directory is gone
+			self.dirs.pop(wd, None)
+			return
+		elif wd not in self.dirs or not name:
+			return
+
+		path = os.path.join(self.dirs[wd], name)
+		isdir = bool(mask & Watcher.IN_ISDIR)
+		if mask & (Watcher.IN_DELETE | Watcher.IN_MOVED_FROM):
+			self.changed.pop(path, None)
+			self.removed[path] = isdir
+		elif isdir:
+			# a directory moved in brings its files with it
+			if mask & (Watcher.IN_CREATE | Watcher.IN_MOVED_TO):
+				for f in self.add_tree(path):
+					self.changed[f] = time.time()
+				self.removed.pop(path, None)
+		else:
+			self.changed[path] = time.time()
+			self.removed.pop(path, None)
+
+	# seconds until the next changed file is due, None if there are none
+	def timeout(self):
+		if not self.changed:
+			return None
+		return max(0, min(self.changed.values())+Settings.properties["watch_delay"]-time.time())
+
+	# takes the changed files that are due and the removed paths, as library -> ([relpaths of the
+	# changed source and copy files], [(relpath, is a directory) of removed paths]) for the
+	# libraries they are tracked by
+	def take(self):
+		now = time.time()
+		due = [p for p, t in self.changed.items() if now-t >= Settings.properties["watch_delay"]]
+		for path in due:
+			del self.changed[path]
+		removed = self.removed.items()
+		self.removed = dict()
+
+		batch = dict()
+		for lib, tracked in self.tracked.items():
+			files = [rel for rel in (self.relpath(lib, p) for p in due) \
+				if rel is not None and lib.match_files([os.path.basename(rel)])]
+			gone = [(rel, isdir) for rel, isdir in \
+				((self.relpath(lib, p), isdir) for p, isdir in removed) if rel is not None]
+			if files or gone:
+				batch[lib] = (files, gone)
+		return batch
+
+	# a path relative to the source of a library if the library tracks it, otherwise None
+	def relpath(self, lib, path):
+		if not path.startswith(os.path.join(lib.source, "")):
+			return None
+		rel = path[len(os.path.join(lib.source, "")):]
+		for p, isfile in self.tracked[lib]:
+			if p == "." or rel == p or (not isfile and rel.startswith(p+os.sep)):
+				return rel
+		return None
+
+#*		Public functions, relative paths
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+# joins a name onto a path relative to a library source, where "." is the source root itself
+def rel_join(reldir, name):
+	if reldir == ".":
+		return name
+	return reldir+os.sep+name
+
+# the directory a relative path is in, "." for the source root
+def rel_dir(rel):
+	return os.path.dirname(rel) or "."
+
+#*		Public functions, files
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+# sha1 of the contents of a file
+def hash_file(path):
+	h = hashlib.sha1()
+	fp = open(path, "rb")
+	try:
+		for block in iter(lambda: fp.read(1 << 20), ""):
+			h.update(block)
+	finally:
+		fp.close()
+	return h.hexdigest()
+
+# hardlinks src to dst, copying it instead if they are on different filesystems
+def link_or_copy(src, dst):
+	try:
+		os.link(src, dst)
+	except OSError:
+		shutil.copy2(src, dst)
+
+# copies src to dst with the cheapest of the copy modes from mode onwards that works for the pair.
+# returns the mode that was used.
+def copy_file(src, dst, mode="reflink"):
+	if os.path.lexists(dst):
+		os.remove(dst)
+
+	for m in copy_modes[copy_modes.index(mode):-1]:
+		try:
+			if m == "link":
+				os.link(src, dst)
+				return m
+			elif m == "reflink":
+				clone_file(src, dst)
+			else:
+				kernel_copy(src, dst)
+			shutil.copystat(src, dst)
+			return m
+		except (IOError, OSError):
+			pass
+
+	shutil.copy2(src, dst)
+	return "buffered"
+
+# shares the data blocks of src with dst on filesystems with copy on write (btrfs, xfs)
+def clone_file(src, dst):
+	fin = open(src, "rb")
+	try:
+		fout = open(dst, "wb")
+		try:
+			fcntl.ioctl(fout.fileno(), 0x40049409, fin.fileno()) # FICLONE
+		finally:
+			fout.close()
+	finally:
+		fin.close()
+
+# copies src to dst without the data passing through python, using copy_file_range where it is
+# available and sendfile otherwise
+def kernel_copy(src, dst):
+	if libc is None:
+		raise OSError("no libc")
+
+	fin = open(src, "rb")
+	try:
+		fout = open(dst, "wb")
+		try:
+			left = os.fstat(fin.fileno()).st_size
+			while left > 0:
+				n = kernel_copy_chunk(fin.fileno(), fout.fileno(), min(left, 1 << 30))
+				if n < 0:
+					raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+				elif n == 0:
+					break
+				left -= n
+		finally:
+			fout.close()
+	finally:
+		fin.close()
+
+# copies up to count bytes between the current offsets of two file descriptors
+def kernel_copy_chunk(fd_in, fd_out, count):
+	if hasattr(libc, "copy_file_range"):
+		libc.copy_file_range.restype = ctypes.c_ssize_t
+		n = libc.copy_file_range(fd_in, None, fd_out, None, ctypes.c_size_t(count), 0)
+		if n >= 0 or ctypes.get_errno() not in (38, 18, 95): # ENOSYS, EXDEV, EOPNOTSUPP
+			return n
+	libc.sendfile.restype = ctypes.c_ssize_t
+	return libc.sendfile(fd_out, fd_in, None, ctypes.c_size_t(count))
+
+#*		Public functions, scheduling
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+# orders jobs, tuples ending in (src, dst), for the workers. "path" is alphabetical, "size" and
+# "duration" put the most expensive jobs first so the long ones don't all end up running on their
+# own at the end.
+def schedule_jobs(jobs, schedule):
+	if schedule == "path":
+		return sorted(jobs, key=lambda job: job[-2:])
+	return sorted(jobs, key=lambda job: job_cost(job[-2], schedule), reverse=True)
+
+# estimated cost of transcoding a source file, in bytes or seconds of audio
+def job_cost(src, schedule):
+	try:
+		if schedule == "duration":
+			seconds = audio_duration(src)
+			if seconds is not None:
+				return seconds
+			# guess from the size as cd quality pcm
+			return os.path.getsize(src) / 176400.0
+		return os.path.getsize(src)
+	except (IOError, OSError):
+		return 0
+
+# length in seconds of a wav or flac file from its header. None for other formats.
+def audio_duration(path):
+	fp = open(path, "rb")
+	try:
+		layout = wav_layout(fp)
+		if layout is not None:
+			byte_rate = struct.unpack("<I", layout[0][8:12])[0]
+			return float(layout[2])/byte_rate if byte_rate else None
+
+		fp.seek(0)
+		head = fp.read(4)
+		if head == "fLaC":
+			# STREAMINFO is always the first metadata block. the sample rate is 20 bits and the
+			# total number of samples 36 bits, starting 10 bytes into it.
+			fp.seek(8)
+			bits = struct.unpack(">Q", fp.read(18)[10:18])[0]
+			rate = bits >> 44
+			if rate:
+				return float(bits & 0xfffffffff)/rate
+		return None
+	finally:
+		fp.close()
+
+# where the audio of an open wav file is, (fmt chunk, data offset, data size). None if it isn't a
+# wav file.
+def wav_layout(fp):
+	fp.seek(0)
+	head = fp.read(12)
+	if head[:4] != "RIFF" or head[8:12] != "WAVE":
+		return None
+
+	fmt = None
+	while True:
+		chunk = fp.read(8)
+		if len(chunk) < 8:
+			return None
+		cid, size = struct.unpack("<4sI", chunk)
+
+		if cid == "fmt ":
+			fmt = fp.read(size)
+			fp.seek(size & 1, 1)
+		elif cid == "data":
+			if fmt is None or len(fmt) < 16:
+				return None
+			# the size is wrong in wavs that were streamed or are over 4GB
+			size = min(size, os.fstat(fp.fileno()).st_size-fp.tell())
+			return (fmt, fp.tell(), size)
+		else:
+			fp.seek(size+(size & 1), 1)
+
+# how to split a source to encode it in parallel, (fmt chunk, duration, [(data offset, size)]) with
+# the segments cut on sample frame boundaries. None unless it is a pcm wav longer than the
+# split_duration setting.
+def split_layout(src):
+	limit = Settings.properties["split_duration"]
+	if limit <= 0 or os.path.splitext(src)[1].lower() not in [".wav", ".wave"]:
+		return None
+
+	fp = open(src, "rb")
+	try:
+		layout = wav_layout(fp)
+	finally:
+		fp.close()
+	if layout is None:
+		return None
+
+	fmt, offset, size = layout
+	tag, channels, rate, byte_rate, block_align = struct.unpack("<HHIIH", fmt[:14])
+	# pcm, float and extensible
+	if tag not in [1, 3, 0xfffe] or not byte_rate or not block_align:
+		return None
+	duration = float(size)/byte_rate
+	if duration <= limit:
+		return None
+
+	count = int(math.ceil(duration/Settings.properties["segment_duration"]))
+	blocks = size//block_align
+	step = -(-blocks//count)*block_align
+	size = blocks*block_align
+	return (fmt, duration, [(offset+i, min(step, size-i)) for i in range(0, size, step)])
+
+# writes part of the audio of a wav file, open as fd, to a wav file of its own
+def write_segment(fd, path, fmt, offset, size):
+	pad = "\0"*(len(fmt) & 1)
+	out = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+	try:
+		os.write(out, "RIFF"+struct.pack("<I", 20+len(fmt+pad)+size+(size & 1))+"WAVE"+ \
+			"fmt "+struct.pack("<I", len(fmt))+fmt+pad+"data"+struct.pack("<I", size))
+		copy_range(fd, out, offset, size)
+		os.write(out, "\0"*(size & 1))
+	finally:
+		os.close(out)
+
+# copies count bytes from an offset of one file descriptor to the current offset of another,
+# inside the kernel when it can
+def copy_range(fd_in, fd_out, offset, count):
+	os.lseek(fd_in, offset, os.SEEK_SET)
+	while count > 0:
+		n = -1
+		if libc is not None:
+			n = kernel_copy_chunk(fd_in, fd_out, min(count, 1 << 30))
+		if n < 0:
+			n = os.write(fd_out, os.read(fd_in, min(count, 1 << 20)))
+		if n == 0:
+			raise IOError("unexpected end of file")
+		count -= n
+
+# length in seconds of an mp3 or ogg file, adding up the frames or chained streams in it. None for
+# other formats, or files that can't be followed to the end.
+def encoded_duration(path):
+	fp = open(path, "rb")
+	try:
+		head = fp.read(4)
+		fp.seek(0)
+		if head == "OggS":
+			return ogg_duration(fp)
+		elif head[:3] == "ID3" or (len(head) == 4 and head[0] == "\xff"):
+			return mp3_duration(fp)
+		return None
+	finally:
+		fp.close()
+
+# length of an mp3 file from its layer III frames. id3 tags can be anywhere, files that have been
+# joined have one at the start of every part, and the xing or info frame at the start of a part
+# holds no audio.
+def mp3_duration(fp):
+	seconds = 0.0
+	while True:
+		head = fp.read(10)
+		if len(head) < 4:
+			return seconds
+		elif head[:3] == "ID3" and len(head) == 10:
+			size = 0
+			for c in head[6:10]:
+				size = (size << 7) | ord(c)
+			fp.seek(size+(10 if ord(head[5]) & 0x10 else 0), 1)
+			continue
+		elif head[:3] == "TAG":
+			fp.seek(118, 1)
+			continue
+
+		h = struct.unpack(">I", head[:4])[0]
+		version = (h >> 19) & 3
+		layer = (h >> 17) & 3
+		index = (h >> 12) & 15
+		if h >> 21 != 0x7ff or version == 1 or layer != 1 or index in [0, 15] or \
+				(h >> 10) & 3 == 3:
+			return None
+
+		mpeg1 = version == 3
+		# mpeg 2 halves the sample rates and mpeg 2.5 halves them again
+		rate = mp3_rates[(h >> 10) & 3] >> [2, 0, 1, 0][version]
+		length = (144 if mpeg1 else 72)*mp3_bitrates[mpeg1][index]*1000//rate + ((h >> 9) & 1)
+		mono = (h >> 6) & 3 == 3
+		side = [[17, 32], [9, 17]][not mpeg1][not mono]
+
+		frame = head+fp.read(max(0, min(length, side+8)-len(head)))
+		if frame[side+4:side+8] not in ["Xing", "Info"]:
+			seconds += (1152.0 if mpeg1 else 576.0)/rate
+		fp.seek(length-len(frame), 1)
+
+# length of an ogg file, adding up every vorbis or opus stream chained in it from the granule
+# position of its last page
+def ogg_duration(fp):
+	# [sample rate, samples to skip, last granule position] of each stream in order, and the
+	# stream each serial number belongs to at this point
+	streams = []
+	current = dict()
+	while True:
+		head = fp.read(27)
+		if len(head) < 27:
+			break
+		elif head[:4] != "OggS":
+			return None
+		granule, serial = struct.unpack("<qI", head[6:18])
+		size = sum(ord(c) for c in fp.read(ord(head[26])))
+
+		if ord(head[5]) & 2:
+			body = fp.read(size)
+			if body[:7] == "\x01vorbis":
+				current[serial] = [struct.unpack("<I", body[12:16])[0], 0, 0]
+			elif body[:8] == "OpusHead":
+				current[serial] = [48000, struct.unpack("<H", body[10:12])[0], 0]
+			else:
+				return None
+			streams.append(current[serial])
+		else:
+			fp.seek(size, 1)
+			if serial in current and granule >= 0:
+				current[serial][2] = granule
+
+	if not streams or not all(s[0] for s in streams):
+		return None
+	return sum(float(max(0, g-skip))/rate for rate, skip, g in streams)
+
+#*		Public function, worker
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+# worker thread to transcode a single item. returns "hit" or "miss" when the cache is enabled.
+# tupe = (script_path, src, dst, drt), drt is None for the segments of a split job, which are
+# neither cached nor reported as jobs of their own
+def transcode_worker(tupe):
+	try:
+		start = time.time()
+		key, hit = cache_lookup(tupe)
+		if hit:
+			return job_result(tupe, "hit", start, 0)
+
+		# a batch script is started for this one job, it reads the job from stdin
+		batch = is_batch_script(tupe[0])
+		if batch and "\n" in tupe[1]+tupe[2]:
+			error = "a batch script can't be given paths with newlines"
+			report_job(tupe, -1, error)
+			return job_result(tupe, None, start, -1, error)
+
+		devnull = open('/dev/null', 'r+')
+		if batch:
+			p = subprocess.Popen([tupe[0], "--batch"], stdin=subprocess.PIPE, \
+				stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=limit_encoder)
+		else:
+			p = subprocess.Popen([tupe[0],tupe[1],work_path(tupe[2])], stdin=devnull, \
+				stdout=devnull, stderr=subprocess.PIPE, preexec_fn=limit_encoder)
+		try:
+			stdout, stderr = p.communicate(tupe[1]+"\n"+work_path(tupe[2])+"\n" if batch else None)
+		finally:
+			# interrupted, or the pool is being terminated
+			if p.returncode is None:
+				stop_encoder(p, tupe)
+		returncode = p.returncode
+		if batch:
+			returncode, error = batch_status(stdout, returncode)
+			stderr += error
+		returncode, error = commit_output(tupe, returncode)
+		stderr += error
+		report_job(tupe, returncode, stderr)
+
+		return job_result(tupe, cache_store(key, tupe, returncode), start, returncode, stderr)
+	except KeyboardInterrupt:
+		pass
+
+# encoders write to a temporary name in the same directory as the output, which is renamed to the
+# output once the encoder has succeeded. an interrupted run never leaves a partial output behind
+# that looks finished.
+def temp_path(dst):
+	head, tail = os.path.split(dst)
+	return os.path.join(head, ".atran-"+tail)
+
+# with a staging directory encoders write there instead, under a name made from the output path.
+# None without one.
+def staged_path(dst):
+	if not Settings.properties["staging_path"]:
+		return None
+	return os.path.join(atran_path, Settings.properties["staging_path"], \
+		hashlib.sha1(dst).hexdigest()[:16]+"-"+os.path.basename(dst))
+
+# where an encoder writes the output for dst
+def work_path(dst):
+	return staged_path(dst) or temp_path(dst)
+
+# the directory the segments of a split job are cut and encoded in, on local disk rather than in
+# the target tree. in the staging directory if there is one.
+def parts_path(dst):
+	root = tempfile.gettempdir()
+	if Settings.properties["staging_path"]:
+		root = os.path.join(atran_path, Settings.properties["staging_path"])
+	return os.path.join(root, "atran-"+hashlib.sha1(dst).hexdigest()[:16]+".parts")
+
+# where a remote worker writes the output for dst while it holds the given lease
+def lease_path(dst, lease):
+	head, tail = os.path.split(work_path(dst))
+	return os.path.join(head, ".lease"+str(lease)+tail)
+
+# the socket family and address of a job server given as host:port, or as the path of a unix
+# socket if it has a slash in
+def parse_address(address):
+	if "/" in address:
+		return (socket.AF_UNIX, address)
+	host, port = address.rsplit(":", 1)
+	return (socket.AF_INET, (host, int(port)))
+
+# moves the output of a job into place if the encoder succeeded, otherwise removes whatever it
+# left. staged outputs stay where they are for the planner to flush. returns (exit status, error
+# message), the status is an error if there is no output.
+def commit_output(tupe, returncode):
+	tmp = work_path(tupe[2])
+	if returncode == 0:
+		try:
+			if tmp == temp_path(tupe[2]):
+				os.rename(tmp, tupe[2])
+			else:
+				os.stat(tmp)
+			return (0, "")
+		except OSError:
+			return (-1, "the encoder didn't write an output")
+	try:
+		os.remove(tmp)
+	except OSError:
+		pass
+	return (returncode, "")
+
+# moves a staged output to its target, renaming it if it's on the same device and copying it
+# otherwise. returns whether it made it.
+def move_staged(staged, dst):
+	try:
+		try:
+			os.rename(staged, dst)
+		except OSError as e:
+			if e.errno != errno.EXDEV:
+				raise
+			copy_file(staged, temp_path(dst), "kernel")
+			os.rename(temp_path(dst), dst)
+			os.remove(staged)
+		return True
+	except (IOError, OSError) as e:
+		print >> sys.stderr, "Error: Failed to move '"+dst+"' out of staging: "+str(e)
+		for path in [staged, temp_path(dst)]:
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+		return False
+
+# kills an encoder started by a worker and removes its partial output
+def stop_encoder(p, tupe):
+	try:
+		p.kill()
+		p.wait()
+	except OSError:
+		pass
+	commit_output(tupe, -1)
+
+# sets up a pool worker process. terminating the pool raises SystemExit in the workers, so they
+# stop their encoders on the way out instead of leaving them running. the targets of the jobs the
+# worker starts on are put on starts.
+def pool_worker_init(starts):
+	global pool_starts
+	pool_starts = starts
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+# runs a job on a pool worker. returns (result, exception), the executor hears back either way.
+def pool_job(worker, tupe):
+	if worker is fanout_worker:
+		for script, dst, drt in tupe[1]:
+			pool_starts.put(dst)
+	else:
+		pool_starts.put(tupe[2])
+	try:
+		return (worker(tupe), None)
+	except Exception as e:
+		return (None, e)
+
+# the (idle, total) time of all cpus from /proc/stat, counting time spent waiting on io as idle.
+# None where there's no /proc/stat.
+def cpu_times():
+	try:
+		with open("/proc/stat") as fp:
+			fields = [int(f) for f in fp.readline().split()[1:]]
+		return (fields[3]+fields[4], sum(fields))
+	except (IOError, ValueError, IndexError):
+		return None
+
+# ioprio_set syscall numbers, python has no wrapper for it and neither does libc
+ioprio_syscalls = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "armv7l": 314}
+ioprio_classes = {"realtime": 1, "best-effort": 2, "idle": 3}
+
+# the io priority the ionice setting asks for, "idle" or a class and level like "best-effort:7".
+# None if it isn't set, can't be read or can't be set on this machine.
+def io_priority():
+	name, sep, level = Settings.properties["ionice"].partition(":")
+	if name not in ioprio_classes or (level and not level.isdigit()) or libc is None or \
+			os.uname()[4] not in ioprio_syscalls:
+		return None
+	return ioprio_classes[name] << 13 | int(level or 0)
+
+# applies the nice, ionice and cpu_affinity settings to an encoder, run in the encoder process just
+# before the script starts. anything that can't be applied is skipped, make_workers warns about it.
+def limit_encoder():
+	try:
+		if Settings.properties["nice"]:
+			os.nice(Settings.properties["nice"])
+	except OSError:
+		pass
+	prio = io_priority()
+	if prio is not None:
+		# IOPRIO_WHO_PROCESS, this process
+		libc.syscall(ioprio_syscalls[os.uname()[4]], 1, 0, prio)
+	cpus = Settings.properties["cpu_affinity"]
+	if cpus and libc is not None and hasattr(libc, "sched_setaffinity"):
+		bits = ctypes.sizeof(ctypes.c_ulong)*8
+		mask = (ctypes.c_ulong*(max(cpus)//bits+1))()
+		for cpu in cpus:
+			mask[cpu//bits] |= 1 << (cpu%bits)
+		libc.sched_setaffinity(0, ctypes.sizeof(mask), mask)
+
+# sets up an encoder in a process group of its own, so it can be killed along with its children
+def encoder_init():
+	os.setsid()
+	limit_encoder()
+
+# kills an encoder started with encoder_init along with anything its script started
+def kill_group(proc):
+	try:
+		os.killpg(proc.pid, signal.SIGKILL)
+	except OSError:
+		pass
+
+# prints how a transcode job went
+def report_job(tupe, returncode, stderr="", timed_out=False):
+	# a segment, the split job reports on the whole output
+	if tupe[3] is None:
+		return
+	name = os.path.relpath(tupe[2], tupe[3])
+	if timed_out:
+		print >> sys.stderr, "Error: Timed out transcoding '"+name+"'"
+	elif returncode != 0:
+		print >> sys.stderr, "Error: Encoder exited with "+str(returncode)+" for '"+name+"'"
+		for line in stderr.strip().splitlines()[-5:]:
+			print >> sys.stderr, "  "+line
+	else:
+		print "t:",name
+
+# megabytes per second as a string for the stats report
+def rate(size, seconds):
+	if not size or not seconds:
+		return "-"
+	return "%.1f" % (size/1048576.0/seconds)
+
+# output size over source size as a string for the stats report
+def ratio(target, source):
+	if not target or not source:
+		return "-"
+	return "%.3f" % (float(target)/source)
+
+# a number of seconds as a short string like 1h02m or 4m05s
+def format_duration(seconds):
+	seconds = int(seconds)
+	if seconds >= 3600:
+		return "%dh%02dm" % (seconds//3600, seconds%3600//60)
+	if seconds >= 60:
+		return "%dm%02ds" % (seconds//60, seconds%60)
+	return "%ds" % seconds
+
+# the result of a transcode job handed back to the planner, (cache, start, end, exit status,
+# source size, target size, stderr). cache is "hit" or "miss" if the cache is enabled and None
+# otherwise. the end of the encoder's stderr is only kept if it failed.
+def job_result(tupe, cache, start, returncode, stderr=""):
+	# a staged output that isn't there was a cache hit, placed in the target directly
+	dst = staged_path(tupe[2])
+	if dst is None or not os.path.exists(dst):
+		dst = tupe[2]
+	sizes = []
+	for path in [tupe[1], dst]:
+		try:
+			sizes.append(os.stat(path).st_size)
+		except OSError:
+			sizes.append(None)
+	stderr = stderr[-ProcessExecutor.stderr_size:] if returncode != 0 else ""
+	return (cache, start, time.time(), returncode, sizes[0], sizes[1], stderr)
+
+# how long to wait before trying a source again after its nth failure, doubling every time
+def retry_delay(failures):
+	return Settings.properties["retry_delay"]*2**(failures-1)
+
+# worker to transcode a source into several outputs while reading it only once. each encoder is
+# given a fifo instead of the source file and the source is copied into all of them.
+# tupe = (src, [(script, dst, drt)])
+def fanout_worker(tupe):
+	try:
+		src, outputs = tupe
+		start = time.time()
+		jobs = []
+		results = dict()
+		for script, dst, drt in outputs:
+			key, hit = cache_lookup((script, src, dst, drt))
+			if hit:
+				results[dst] = job_result((script, src, dst, drt), "hit", start, 0)
+			else:
+				jobs.append((key, (script, src, dst, drt)))
+
+		tmp = tempfile.mkdtemp(prefix="atran-")
+		devnull = open('/dev/null', 'r+')
+		try:
+			procs = []
+			fds = []
+			# stderr goes to files, an encoder blocked writing to a full pipe would stall the tee
+			errs = []
+			for i, (key, job) in enumerate(jobs):
+				# the fifo keeps the name of the source, scripts may look at the extension
+				fifo = os.path.join(tmp, str(i)+"-"+os.path.basename(src))
+				os.mkfifo(fifo)
+				errs.append(open(os.path.join(tmp, str(i)+".err"), "w+b"))
+				p = subprocess.Popen([job[0], fifo, work_path(job[2])], stdin=devnull, \
+					stdout=devnull, stderr=errs[-1], preexec_fn=limit_encoder)
+				procs.append(p)
+				fd = open_fifo(fifo, p)
+				if fd is not None:
+					fds.append(fd)
+
+			tee(src, fds)
+
+			for (key, job), p, err in zip(jobs, procs, errs):
+				p.wait()
+				returncode, error = commit_output(job, p.returncode)
+				stderr = read_tail(err)+error
+				report_job(job, returncode, stderr)
+				results[job[2]] = job_result(job, cache_store(key, job, returncode), start, \
+					returncode, stderr)
+		finally:
+			devnull.close()
+			shutil.rmtree(tmp, True)
+			for (key, job), p in zip(jobs, procs):
+				if p.returncode is None:
+					stop_encoder(p, job)
+
+		# in the same order as the outputs
+		return [results[dst] for script, dst, drt in outputs]
+	except KeyboardInterrupt:
+		pass
+
+# the end of what has been written to a file since an offset, at most as much stderr as is kept
+def read_tail(fp, offset=0):
+	fp.seek(0, os.SEEK_END)
+	fp.seek(max(offset, fp.tell()-ProcessExecutor.stderr_size))
+	return fp.read()
+
+# opens a fifo for writing once the encoder reading it has opened it. returns None if the encoder
+# exits without opening it.
+def open_fifo(path, proc):
+	while True:
+		try:
+			fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+			break
+		except OSError as e:
+			if e.errno != errno.ENXIO:
+				raise
+			if proc.poll() is not None:
+				return None
+			time.sleep(0.01)
+
+	flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+	fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+	return fd
+
+# copies a file into each of a list of file descriptors, which are closed afterwards. a
+# descriptor that can't be written to any more, because the encoder has stopped reading, is
+# dropped.
+def tee(path, fds):
+	try:
+		fp = open(path, "rb")
+		try:
+			while fds:
+				block = fp.read(1 << 20)
+				if not block:
+					break
+				for fd in list(fds):
+					try:
+						view = buffer(block)
+						while len(view) > 0:
+							view = buffer(view, os.write(fd, view))
+					except OSError as e:
+						if e.errno != errno.EPIPE:
+							raise
+						fds.remove(fd)
+						os.close(fd)
+		finally:
+			fp.close()
+	finally:
+		for fd in fds:
+			os.close(fd)
+
+# feeds the source of a fanout job to the fifos of its (fifo, encoder process) list and removes
+# them afterwards. the encoders are killed if the source can't be read, rather than left to finish
+# a short output.
+def feed_fifos(src, fifos, tmp):
+	fds = []
+	try:
+		try:
+			for path, proc in fifos:
+				fd = open_fifo(path, proc)
+				if fd is not None:
+					fds.append(fd)
+		except OSError:
+			for fd in fds:
+				os.close(fd)
+			raise
+		tee(src, fds)
+	except (IOError, OSError) as e:
+		print >> sys.stderr, "Error: Failed to read '"+src+"': "+str(e)
+		for path, proc in fifos:
+			kill_group(proc)
+	finally:
+		shutil.rmtree(tmp, True)
+
+# the exit status of a job from the line a batch encoder wrote for it, given the exit status of
+# the encoder for when there's no line. returns (exit status, error message).
+def batch_status(reply, returncode):
+	try:
+		return (int(reply.split(" ", 1)[0]), "")
+	except ValueError:
+		return (returncode or -1, "batch encoder gave no status: "+repr(reply[:200]))
+
+# whether an encoder script speaks the batch protocol of BatchExecutor
+def is_batch_script(path):
+	try:
+		fp = open(path, "rb")
+		try:
+			return any("atran-protocol: batch" in fp.readline() for i in range(10))
+		finally:
+			fp.close()
+	except IOError:
+		return False
+
+# looks up a job in the cache, placing the output if it's there. returns (key, hit).
+def cache_lookup(tupe):
+	# only the joined output of a split job is cached, not its segments
+	if cache is None or tupe[3] is None:
+		return (None, False)
+	try:
+		key = cache.key(tupe[0], tupe[1], tupe[2])
+		if cache.fetch(key, tupe[2]):
+			print "t:",os.path.relpath(tupe[2], tupe[3]),"(cached)"
+			return (key, True)
+		return (key, False)
+	except (IOError, OSError):
+		return (None, False)
+
+# adds the output of a finished job to the cache. returns "miss" when the cache is enabled.
+def cache_store(key, tupe, returncode):
+	if key is None or returncode != 0:
+		return None
+	try:
+		cache.store(key, staged_path(tupe[2]) or tupe[2])
+	except (IOError, OSError):
+		pass
+	return "miss"
+
+# worker thread to copy a single item. a copy that fails leaves nothing behind and is reported
+# like a failed transcode, so the rest of the run goes on.
+# tupe = (src, dst, drt, copy_mode)
+def copy_worker(tupe):
+	start = time.time()
+	tmp = temp_path(tupe[1])
+	try:
+		copy_file(tupe[0], tmp, tupe[3])
+		os.rename(tmp, tupe[1])
+	except (IOError, OSError) as e:
+		try:
+			os.remove(tmp)
+		except OSError:
+			pass
+		print >> sys.stderr, "Error: Failed to copy '"+os.path.relpath(tupe[1], tupe[2])+"':", \
+			e.strerror or e
+		return job_result((None, tupe[0], tupe[1]), None, start, e.errno or 1, str(e))
+	print "c:",os.path.relpath(tupe[1], tupe[2])
+	return job_result((None, tupe[0], tupe[1]), None, start, 0)
+
+#*		Tool Commands
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+# edit libraries
+def cmd_library(args):
+	if args.new:
+		# add a library
+		Library(args.new[0], args.new[1], args.new[2])
+	elif args.delete:
+		# deletes a library
+		Library.remove(args.delete)
+	elif args.script:
+		# set script path
+		name, path = args.script
+		Library(name).set_script_path(path)
+	elif args.source_ext:
+		# set source extension
+		name, ext = args.source_ext
+		Library(name).ext("source",ext)
+	elif args.target_ext:
+		# set target extension
+		name, ext = args.target_ext
+		Library(name).ext("target",ext)
+	elif args.add_copy:
+		# add copy extension
+		name, exts = args.add_copy
+		Library(name).ext("copy",append=exts.replace(",", " "))
+	elif args.clear_copy:
+		# remove all copy extensions
+		name = args.clear_copy
+		Library(name).ext("copy",set="")
+	elif args.copy_mode:
+		# set how copy files are copied
+		name, mode = args.copy_mode
+		if mode in copy_modes:
+			Library(name).set_copy_mode(mode)
+		else:
+			print >> sys.stderr, "Error: Copy mode must be one of "+", ".join(copy_modes)+"."
+	elif args.add_profile:
+		# add an output profile
+		name, target, ext, script = args.add_profile
+		Library(name).add_profile(target, ext, script)
+	elif args.remove_profile:
+		# remove an output profile
+		name, target = args.remove_profile
+		Library(name).remove_profile(target)
+	elif args.export:
+		# export a library as json lines
+		Library(args.export).export_lines(sys.stdout)
+	elif args.import_lib:
+		# import a library from json lines or a json document
+		try:
+			Library.import_lines(sys.stdin)
+		except (ValueError, KeyError, TypeError):
+			print >> sys.stderr, "Error: The input isn't a library exported by atran."
+
+# list libraries or paths of libraries
+def cmd_list(args):
+	if args.failed is not None:
+		# list the failing files of one or all libraries
+		for name in [args.failed] if args.failed else Library.list_names():
+			print "  [",name,"]"
+			Library(name).list_failures()
+	elif args.paths:
 		# list paths of a library
 		Library(args.paths).list_paths()
 	else:
@@ -447,19 +4100,19 @@ def cmd_path(args):
 	elif args.import_paths:
 		# import multiple paths from stdin
 		lib = Library(args.import_paths)
-		while True:
-			try:
-				path = raw_input()
-				if path == "":
-					break
-				try:
-					lib.add_path(path)
-				except Library.OutsideSource:
-					print >> sys.stderr, "Error: Path is outside of the library source path."
-				except Path.AlreadyExists:
-					print >> sys.stderr, "Error: Path already in library database!"
-			except EOFError:
+		paths = []
+		for line in sys.stdin:
+			path = line.rstrip("\n")
+			if path == "":
 				break
+			try:
+				paths.append(lib.check_path(path))
+			except Library.OutsideSource:
+				print >> sys.stderr, "Error: Path is outside of the library source path."
+
+		existing = len(paths)-lib.add_paths(paths, False)
+		if existing > 0:
+			print >> sys.stderr, "Error: "+str(existing)+" paths already in library database!"
 	elif args.export:
 		# export paths from a library
 		Library(args.export).export_paths()
@@ -472,6 +4125,10 @@ def cmd_path(args):
 		name, path = args.remove_only
 		Library(name).remove_only_path(path)
 
+# reports on the jobs of past runs
+def cmd_stats(args):
+	JobHistory.report(args.library, args.slowest)
+
 # at the moment just to initialise the profile database.
 def cmd_config(args):
 	if args.newdb:
@@ -481,64 +4138,475 @@ def cmd_config(args):
 		fp.close()
 		
 		dbc = sqlite3.connect(os.path.join(atran_path, "profile.db3"))
-		dbc.execute("CREATE TABLE libraries \
-			(	id INTEGER PRIMARY KEY, \
-				name TEXT, \
-				source TEXT, \
-				target TEXT, \
-				script_path TEXT, \
-				source_ext TEXT, \
-				target_ext TEXT, \
-				copy_ext TEXT, \
-				UNIQUE (name))")
-		dbc.execute("CREATE TABLE paths \
-			(	id INTEGER PRIMARY KEY, \
-				lid INTEGER, \
-				path TEXT, \
-				UNIQUE (lid, path) \
-				FOREIGN KEY (lid) REFERENCES libraries(id))")
-
-		dbc.commit()
+		create_database(dbc)
 		print "New profile database successfully created."
 
+# creates the tables of a new profile database
+def create_database(db):
+	db.execute("CREATE TABLE libraries \
+		(	id INTEGER PRIMARY KEY, \
+			name TEXT, \
+			source TEXT, \
+			target TEXT, \
+			script_path TEXT, \
+			source_ext TEXT, \
+			target_ext TEXT, \
+			copy_ext TEXT, \
+			copy_mode TEXT, \
+			UNIQUE (name))")
+	db.execute("CREATE TABLE paths \
+		(	id INTEGER PRIMARY KEY, \
+			lid INTEGER, \
+			path TEXT, \
+			UNIQUE (lid, path) \
+			FOREIGN KEY (lid) REFERENCES libraries(id))")
+	upgrade_database(db)
+	db.commit()
+
+# creates any tables that are missing from a profile database made by an older version.
+def upgrade_database(db):
+	columns = [row[1] for row in db.execute("PRAGMA table_info(libraries)")]
+	if "copy_mode" not in columns:
+		db.execute("ALTER TABLE libraries ADD COLUMN copy_mode TEXT DEFAULT 'reflink'")
+
+	db.execute("CREATE TABLE IF NOT EXISTS dirs \
+		(	id INTEGER PRIMARY KEY, \
+			lid INTEGER, \
+			path TEXT, \
+			parent TEXT, \
+			mtime REAL, \
+			UNIQUE (lid, path) \
+			FOREIGN KEY (lid) REFERENCES libraries(id))")
+	db.execute("CREATE TABLE IF NOT EXISTS files \
+		(	id INTEGER PRIMARY KEY, \
+			lid INTEGER, \
+			path TEXT, \
+			dir TEXT, \
+			size INTEGER, \
+			mtime REAL, \
+			target_size INTEGER, \
+			target_mtime REAL, \
+			UNIQUE (lid, path) \
+			FOREIGN KEY (lid) REFERENCES libraries(id))")
+	db.execute("CREATE TABLE IF NOT EXISTS profiles \
+		(	id INTEGER PRIMARY KEY, \
+			lid INTEGER, \
+			target TEXT, \
+			target_ext TEXT, \
+			script_path TEXT, \
+			UNIQUE (lid, target) \
+			FOREIGN KEY (lid) REFERENCES libraries(id))")
+	db.execute("CREATE TABLE IF NOT EXISTS profile_files \
+		(	id INTEGER PRIMARY KEY, \
+			lid INTEGER, \
+			pid INTEGER, \
+			path TEXT, \
+			size INTEGER, \
+			mtime REAL, \
+			target_size INTEGER, \
+			target_mtime REAL, \
+			UNIQUE (pid, path) \
+			FOREIGN KEY (pid) REFERENCES profiles(id))")
+	db.execute("CREATE TABLE IF NOT EXISTS outputs \
+		(	id INTEGER PRIMARY KEY, \
+			lid INTEGER, \
+			pid INTEGER, \
+			path TEXT, \
+			source TEXT, \
+			UNIQUE (lid, pid, path) \
+			FOREIGN KEY (lid) REFERENCES libraries(id))")
+	db.execute("CREATE TABLE IF NOT EXISTS failures \
+		(	id INTEGER PRIMARY KEY, \
+			lid INTEGER, \
+			pid INTEGER, \
+			path TEXT, \
+			size INTEGER, \
+			mtime REAL, \
+			script_path TEXT, \
+			failures INTEGER, \
+			last REAL, \
+			stderr TEXT, \
+			UNIQUE (lid, pid, path) \
+			FOREIGN KEY (lid) REFERENCES libraries(id))")
+	db.execute("CREATE TABLE IF NOT EXISTS journal \
+		(	id INTEGER PRIMARY KEY, \
+			lid INTEGER, \
+			pid INTEGER, \
+			source TEXT, \
+			target TEXT, \
+			state TEXT, \
+			UNIQUE (lid, target) \
+			FOREIGN KEY (lid) REFERENCES libraries(id))")
+	db.execute("CREATE TABLE IF NOT EXISTS jobs \
+		(	id INTEGER PRIMARY KEY, \
+			library TEXT, \
+			script_path TEXT, \
+			source TEXT, \
+			target TEXT, \
+			source_size INTEGER, \
+			target_size INTEGER, \
+			start REAL, \
+			end REAL, \
+			status INTEGER, \
+			cached INTEGER)")
+	db.commit()
+
+# the executor set up by the settings, or an empty list when not multithreaded
+def make_workers():
+	if not Settings.properties["multithreaded"]:
+		return []
+
+	size = configured_cores()
+	if Settings.properties["ionice"] and io_priority() is None:
+		print >> sys.stderr, "Warning: Can't set the io priority '"+Settings.properties["ionice"]+ \
+			"' of encoders on this machine, it should be 'idle' or like 'best-effort:7'."
+
+	governor = None
+	if Settings.properties["governor"]:
+		if Settings.properties["executor"] == "process":
+			governor = Governor(size, Settings.properties["min_cores"], \
+				Settings.properties["max_cores"] or 2*multiprocessing.cpu_count())
+			size = governor.size
+		else:
+			print >> sys.stderr, "Warning: The governor only works with the process executor, \
+				running a fixed number of workers."
+
+	if Settings.properties["executor"] == "process":
+		workers = ProcessExecutor(size, Settings.properties["job_timeout"], governor)
+	else:
+		workers = PoolExecutor(size)
+	return BatchExecutor(size, workers, Settings.properties["job_timeout"])
+
+# the number of encoders to run at once, from the cores setting
+def configured_cores():
+	if Settings.properties["cores"] > 1:
+		return Settings.properties["cores"]
+	return multiprocessing.cpu_count()
+
+# the number of encoders the workers run at once, for the banner
+def worker_count(workers):
+	if not workers:
+		return "1"
+	governor = getattr(workers.fallback, "governor", None)
+	if governor is not None:
+		return str(governor.size)+" (adapting between "+str(governor.low)+" and "+ \
+			str(governor.high)+")"
+	return str(workers.size)
+
+# sets up a database connection. with a write ahead log commits are cheap and readers aren't
+# blocked by a run writing to the database.
+def configure_database(db):
+	db.execute("PRAGMA journal_mode=WAL")
+	db.execute("PRAGMA synchronous=NORMAL")
+
 # default behaviour.
 def cmd_run(args):
+	global cache
+
+	# the cache is set before the pool workers are forked, or they would run without it
+	if Settings.properties["cache_size"] > 0:
+		cache = TranscodeCache(os.path.join(atran_path, Settings.properties["cache_path"]), \
+			Settings.properties["cache_size"]*1024*1024)
+
 	# transcode anything that's missing
+	workers = make_workers()
 	print "--- Audio Transcoder ---"
-	print "  Workers: "+str(multiprocessing.cpu_count())
+	print "  Workers: "+worker_count(workers)
 	print
 	
-	workers = []
-	if Settings.properties["multithreaded"]:
-		if Settings.properties["cores"] > 1:
-			workers = multiprocessing.Pool(Settings.properties["cores"])
-		else:
-			workers = multiprocessing.Pool()
-	
 	if len(args.todo) == 1:
 		# only process a specific library
-		lib = Library(args.todo[0])
-		print "  [",args.todo[0],"]"
-		lib.clean_tree()
-		lib.transcode(workers, args.force)
+		libraries = [Library(args.todo[0])]
 	elif len(args.todo) == 2:
 		# process this as a source, target directory and process all files in it.
 		# only process a specific library
-		lib = Library(args.todo[0], args.todo[1])
-		lib.clean_tree()
-		lib.transcode(workers, args.force)
+		libraries = [Library(args.todo[0], args.todo[1])]
 	else:
 		# process all libraries
-		for name in sorted(Library.list_names()):
-			lib = Library(name)
-			print "  [",name,"]"
-			lib.clean_tree()
-			lib.transcode(workers, args.force)
+		libraries = [Library(name) for name in sorted(Library.list_names())]
+
+	progress = None
+	if args.progress or args.progress_fd is not None or args.status:
+		if args.progress:
+			out = open(args.progress, "w")
+		elif args.progress_fd is not None:
+			out = os.fdopen(args.progress_fd, "w")
+		else:
+			out = None
+		progress = Progress(out, args.status, workers.size if workers else 1)
+
+	try:
+		RunPlanner(libraries, workers, args.force, args.stream, args.schedule, True, \
+			args.deep_clean, progress).run()
+	except KeyboardInterrupt:
+		if Settings.properties["multithreaded"]:
+			workers.terminate()
+		raise
 
 	if Settings.properties["multithreaded"]:
 		workers.close()
 		workers.join()
 
+	if cache is not None:
+		cache.evict()
+		print
+		print "Cache: "+str(cache.hits)+" hits, "+str(cache.misses)+" misses"
+
+# keeps transcoding libraries as their sources change, until interrupted. without inotify the
+# libraries are run every poll_interval seconds instead.
+def cmd_watch(args):
+	global cache
+
+	if Settings.properties["cache_size"] > 0:
+		cache = TranscodeCache(os.path.join(atran_path, Settings.properties["cache_path"]), \
+			Settings.properties["cache_size"]*1024*1024)
+
+	workers = make_workers()
+	print "--- Audio Transcoder ---"
+	print "  Workers: "+worker_count(workers)
+	print
+
+	if args.libraries:
+		libraries = [Library(name) for name in args.libraries]
+	else:
+		libraries = [Library(name) for name in sorted(Library.list_names())]
+
+	try:
+		watch(libraries, workers)
+	except KeyboardInterrupt:
+		if Settings.properties["multithreaded"]:
+			workers.terminate()
+		raise
+
+# the loop of cmd_watch. everything is run once to catch up, after that only the files that
+# change are.
+def watch(libraries, workers):
+	RunPlanner(libraries, workers).run()
+	try:
+		watcher = Watcher(libraries)
+	except OSError as e:
+		print >> sys.stderr, "Warning: Can't watch the libraries ("+str(e)+"), running them every", \
+			Settings.properties["poll_interval"],"seconds instead."
+		watcher = None
+
+	print
+	print "watching for changes..."
+	while True:
+		if watcher is None or watcher.overflow:
+			if watcher is None:
+				time.sleep(Settings.properties["poll_interval"])
+			else:
+				print >> sys.stderr, "Warning: Too many changes at once, scanning everything."
+				watcher.overflow = False
+			# the indexes are loaded again along with the tracked paths
+			for lib in libraries:
+				lib.index = None
+			RunPlanner(libraries, workers).run()
+			continue
+
+		watcher.read(watcher.timeout())
+		batch = watcher.take()
+		for lib, (files, removed) in batch.items():
+			if removed:
+				print "  [",lib.name,"] removed:",lib.remove_sources(removed),"outputs of deleted files"
+				lib.index.save()
+			# only the changed files are scanned
+			lib.paths = files
+		changed = [lib for lib in libraries if lib in batch and batch[lib][0]]
+		if changed:
+			RunPlanner(changed, workers, stream=True, clean=False).run()
+
+# scans libraries like run without changing anything, printing what a run would do and an
+# estimate of how long it would take
+def cmd_plan(args):
+	size = configured_cores()
+	print "--- Audio Transcoder ---"
+	print "  Workers: "+str(size)
+	print
+
+	if len(args.todo) == 1:
+		libraries = [Library(args.todo[0])]
+	elif len(args.todo) == 2:
+		libraries = [Library(args.todo[0], args.todo[1])]
+	else:
+		libraries = [Library(name) for name in sorted(Library.list_names())]
+
+	# script path -> [(source size, source, output extension)] of the transcode jobs
+	scripts = dict()
+	for lib in libraries:
+		plan_library(lib, args.force, args.list, scripts)
+		print
+
+	print "Estimate:"
+	seconds = []
+	unknown = 0
+	for script in sorted(scripts):
+		jobs = scripts[script]
+		speed = JobHistory.throughput(script)
+		measured = "recorded jobs"
+		if speed is None and args.calibrate:
+			# the median source is a fair sample of the rest
+			sample = sorted(jobs)[len(jobs)//2]
+			speed = calibrate(script, sample[1], sample[2])
+			measured = "a test run"
+		if speed is None:
+			unknown += len(jobs)
+			print "  %-30s %7d files, nothing to estimate from" % (script, len(jobs))
+			continue
+		print "  %-30s %7d files %8s MB/s from %s" % (script, len(jobs), rate(speed, 1), measured)
+		seconds.extend(job[0]/speed for job in jobs)
+
+	if seconds:
+		# the longest job can't be shared out between workers
+		total = max(sum(seconds)/size, max(seconds))
+		print "  about "+format_duration(total)+" with "+str(size)+" workers"
+	if unknown > 0 and args.calibrate:
+		print "  "+str(unknown)+" files left out, their scripts failed on a test run"
+	elif unknown > 0:
+		print "  "+str(unknown)+" files left out, run with --calibrate to time their scripts"
+
+# scans a library for cmd_plan without making target directories or writing to the database.
+# prints the jobs the library has, each of them with listing on, and adds its transcode jobs to
+# scripts.
+def plan_library(lib, force, listing, scripts):
+	lib.open_index()
+	tr = []
+	cp = []
+	for kind, src, dst, profile in lib.scan_files(force, False):
+		(tr if kind == "tr" else cp).append((src, dst, profile))
+	orphans = lib.index.orphans() if os.path.isdir(lib.source) and not lib.index.unreadable else []
+
+	print "  [",lib.name,"]"
+	if listing:
+		for src, dst, profile in tr:
+			print "t:",os.path.relpath(dst, profile.target)
+		for src, dst, profile in cp:
+			print "c:",os.path.relpath(dst, profile.target)
+		for dst in sorted(orphans):
+			print "r:",dst
+
+	sizes = dict()
+	duration = 0.0
+	unknown = 0
+	for src in set(src for src, dst, profile in tr+cp):
+		try:
+			sizes[src] = os.path.getsize(src)
+		except OSError:
+			sizes[src] = 0
+	for src in set(src for src, dst, profile in tr):
+		try:
+			seconds = audio_duration(src)
+		except IOError:
+			seconds = None
+		if seconds is None:
+			unknown += 1
+		else:
+			duration += seconds
+	for src, dst, profile in tr:
+		scripts.setdefault(profile.script_path, []).append((sizes[src], src, profile.ext))
+
+	sources = set(src for src, dst, profile in tr)
+	print "  transcode:",len(tr),"outputs of",len(sources),"files,", \
+		"%.1f MB," % (sum(sizes[s] for s in sources)/1048576.0), \
+		format_duration(duration),"of audio", \
+		"("+str(unknown)+" files of unknown length)" if unknown else ""
+	print "  copy:     ",len(cp),"files,","%.1f MB" % (sum(sizes[s] for s, d, p in cp)/1048576.0)
+	print "  remove:   ",len(orphans),"orphaned files"
+	print "  skipped:  ",sum(lib.skipped),"up to date,",lib.index.held,"failing files held back"
+
+# times a script on one source, for an estimate when it has no recorded jobs. returns source
+# bytes a second, or None if the script failed.
+def calibrate(script, src, ext):
+	tmp = tempfile.mkdtemp()
+	devnull = open(os.devnull, "r+")
+	try:
+		start = time.time()
+		out = os.path.join(tmp, "calibrate"+ext)
+		returncode = subprocess.call([script, src, out], stdin=devnull, stdout=devnull, \
+			stderr=devnull, preexec_fn=limit_encoder)
+		seconds = time.time()-start
+		if returncode != 0 or seconds <= 0 or not os.path.exists(out):
+			return None
+		return os.path.getsize(src)/seconds
+	except OSError:
+		return None
+	finally:
+		devnull.close()
+		shutil.rmtree(tmp, True)
+
+# runs libraries like cmd_run, handing the transcode jobs to atran worker processes instead of
+# encoding them here
+def cmd_serve(args):
+	global cache
+
+	address = args.address or Settings.properties["server_address"]
+	print "--- Audio Transcoder ---"
+	print "  Serving jobs on: "+address
+	print
+
+	if Settings.properties["cache_size"] > 0:
+		cache = TranscodeCache(os.path.join(atran_path, Settings.properties["cache_path"]), \
+			Settings.properties["cache_size"]*1024*1024)
+
+	# workers take jobs one output at a time and can't see the segments of a split job, which are
+	# cut on this machine. the planner only waits on them when it thinks they run in the background.
+	Settings.properties["fanout"] = False
+	Settings.properties["split_duration"] = 0
+	Settings.properties["multithreaded"] = True
+	workers = JobServer(address, Settings.properties["lease_time"])
+
+	if len(args.todo) == 1:
+		libraries = [Library(args.todo[0])]
+	elif len(args.todo) == 2:
+		libraries = [Library(args.todo[0], args.todo[1])]
+	else:
+		libraries = [Library(name) for name in sorted(Library.list_names())]
+
+	try:
+		RunPlanner(libraries, workers, args.force, args.stream, args.schedule).run()
+	except KeyboardInterrupt:
+		workers.terminate()
+		raise
+
+	workers.close()
+	workers.join()
+
+	if cache is not None:
+		cache.evict()
+		print
+		print "Cache: "+str(cache.hits)+" hits, "+str(cache.misses)+" misses"
+
+# takes jobs from an atran serve and runs their encoders, jobs at a time, until the server is done
+def cmd_worker(args):
+	size = args.jobs
+	if size < 1:
+		size = multiprocessing.cpu_count()
+	address = args.address or Settings.properties["server_address"]
+	print "--- Audio Transcoder ---"
+	print "  Worker of: "+address
+	print "  Jobs: "+str(size)
+	print
+
+	workers = [RemoteWorker(address) for i in range(size)]
+	threads = []
+	for w in workers:
+		t = threading.Thread(target=w.run)
+		t.daemon = True
+		t.start()
+		threads.append(t)
+
+	try:
+		for t in threads:
+			while t.is_alive():
+				t.join(0xffff)
+	except KeyboardInterrupt:
+		# the server hands the jobs out again once the connections close
+		for w in workers:
+			w.halt()
+		for t in threads:
+			t.join()
+		raise
+
 #*		Main
 #*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
 if __name__ == "__main__":
@@ -555,6 +4623,15 @@ if __name__ == "__main__":
 		dest="paths",
 		metavar="LIBRARY",
 		help="Lists the paths associated with the named library.")
+	p_list.add_argument("--failed", "-f",
+		nargs="?",
+		const="",
+		type=str,
+		dest="failed",
+		metavar="LIBRARY",
+		help="Lists the files the encoder keeps failing on, of the named library or all of them. \
+			These are held back from runs until a retry is due, or for good after retry_limit \
+			failures, unless the file or the encoder script changes.")
 
 	# library - configure libraries
 	p_library = subparsers.add_parser("library", help="Configure libraries.")
@@ -605,15 +4682,40 @@ if __name__ == "__main__":
 		metavar="LIBRARY",
 		help="Clears the copy extension list for a library. After calling this command no files \
 			will be copied over from the source to target tree.")
+	p_library.add_argument("--copy-mode", "-cm",
+		nargs=2,
+		type=str,
+		dest="copy_mode",
+		metavar=("LIBRARY", "MODE"),
+		help="Set how copy files are copied for a library. One of 'link' (hardlink), 'reflink' \
+			(share the data on a copy on write filesystem), 'kernel' (copy without reading the \
+			file into the transcoder) or 'buffered' (a plain copy). If a mode can't be used for a \
+			file the next one in that list is used instead.")
+	p_library.add_argument("--add-profile", "-ap",
+		nargs=4,
+		type=str,
+		dest="add_profile",
+		metavar=("LIBRARY", "TARGET", "EXT", "SCRIPT"),
+		help="Add an output profile to a library, transcoding the same sources into another \
+			target directory with another extension and script. Each source is read once for \
+			all the profiles that need it.")
+	p_library.add_argument("--remove-profile", "-rp",
+		nargs=2,
+		type=str,
+		dest="remove_profile",
+		metavar=("LIBRARY", "TARGET"),
+		help="Remove the output profile with a target directory from a library.")
 	p_library.add_argument("--export", "-e",
 		type=str,
 		dest="export",
 		metavar="LIBRARY",
-		help="Export a library to JSON format.")
+		help="Export a library as JSON lines, a header with the library's settings followed by a \
+			line for each path.")
 	p_library.add_argument("--import", "-i",
 		action="store_true",
 		dest="import_lib",
-		help="Import a library from JSON format.")
+		help="Import a library from the standard input, exported as JSON lines or in the older \
+			single JSON document format.")
 
 	# path operations
 	p_path = subparsers.add_parser("path", help="Configure paths for a library.")
@@ -667,6 +4769,41 @@ if __name__ == "__main__":
 		dest="force",
 		help="Force all scanned files to be processed even if there is already a target file for \
 			it.")
+	p_run.add_argument("--stream", "-s",
+		action="store_true",
+		dest="stream",
+		help="Start transcoding files as soon as they are found instead of after the whole library \
+			has been scanned. Files are processed in the order they are found.")
+	p_run.add_argument("--schedule",
+		type=str,
+		dest="schedule",
+		choices=["path", "size", "duration"],
+		default=None,
+		help="Order the transcode jobs are started in. 'path' is alphabetical, 'size' and \
+			'duration' start the biggest or longest sources first, with the duration read from the \
+			header of WAV and FLAC files. Defaults to the 'schedule' setting. Ignored with \
+			--stream.")
+	p_run.add_argument("--deep-clean",
+		action="store_true",
+		dest="deep_clean",
+		help="Walk the whole target tree removing files the library doesn't make and empty \
+			directories. Without it only outputs of earlier runs whose source is gone or no longer \
+			tracked are removed.")
+	p_run.add_argument("--progress",
+		type=str,
+		dest="progress",
+		metavar="FILE",
+		help="Write the progress of the run to a file as json lines, an event for every job \
+			queued, started, finished or failed and a snapshot of the whole run every second.")
+	p_run.add_argument("--progress-fd",
+		type=int,
+		dest="progress_fd",
+		metavar="FD",
+		help="Write the progress of the run as json lines to an open file descriptor instead.")
+	p_run.add_argument("--status",
+		action="store_true",
+		dest="status",
+		help="Show a status line with the rate, worker utilization and time left on the terminal.")
 	p_run.add_argument("todo",
 		nargs="*",
 		type=str,
@@ -674,6 +4811,98 @@ if __name__ == "__main__":
 			directory and the transcoder will process those (with the default settings in \
 			settings.json for a path tuple). Leave empty to process all libraries.")
 
+	# stats - reports on past runs
+	p_stats = subparsers.add_parser("stats", help="Report on the transcode jobs of past runs.")
+	p_stats.set_defaults(cmd="stats")
+	p_stats.add_argument("--slowest", "-n",
+		type=int,
+		dest="slowest",
+		default=10,
+		help="Number of the slowest files to list.")
+	p_stats.add_argument("library",
+		nargs="?",
+		type=str,
+		help="Only report on the jobs of this library.")
+
+	# watch - keep transcoding as sources change
+	p_watch = subparsers.add_parser("watch", help="Transcode libraries as their sources change.")
+	p_watch.set_defaults(cmd="watch")
+	p_watch.add_argument("libraries",
+		nargs="*",
+		type=str,
+		help="Libraries to watch. Leave empty to watch all libraries. Everything is run once first, \
+			after that files that are written, moved in or deleted under the tracked paths are \
+			processed a few seconds after they stop changing.")
+
+	# plan - dry run
+	p_plan = subparsers.add_parser("plan", help="Show what a run would do and estimate how long it \
+		would take, without changing anything.")
+	p_plan.set_defaults(cmd="plan")
+	p_plan.add_argument("--force", "-f",
+		action="store_true",
+		dest="force",
+		help="Plan as if every file had to be processed again, like run --force.")
+	p_plan.add_argument("--list", "-l",
+		action="store_true",
+		dest="list",
+		help="List every output that would be transcoded (t:), copied (c:) or removed (r:).")
+	p_plan.add_argument("--calibrate", "-c",
+		action="store_true",
+		dest="calibrate",
+		help="Time scripts that have no recorded jobs on one of their files, so they can be \
+			part of the estimate.")
+	p_plan.add_argument("todo",
+		nargs="*",
+		type=str,
+		help="A library, or a source and target directory, like run. Leave empty to plan all \
+			libraries.")
+
+	# serve - hand out the jobs of a run to workers
+	p_serve = subparsers.add_parser("serve", help="Run the transcoder with the encoding done by \
+		atran worker processes.")
+	p_serve.set_defaults(cmd="serve")
+	p_serve.add_argument("--address", "-a",
+		type=str,
+		dest="address",
+		default=None,
+		help="Where to listen for workers, host:port or the path of a unix socket. Defaults to \
+			the server_address setting.")
+	p_serve.add_argument("--force", "-f",
+		action="store_true",
+		dest="force",
+		help="Force all scanned files to be processed even if there is already a target file for \
+			it.")
+	p_serve.add_argument("--stream", "-s",
+		action="store_true",
+		dest="stream",
+		help="Hand out jobs as soon as they are found instead of after the whole library has been \
+			scanned.")
+	p_serve.add_argument("--schedule",
+		choices=["path", "size", "duration"],
+		dest="schedule",
+		help="Order the jobs are handed out in, see run --schedule.")
+	p_serve.add_argument("todo",
+		nargs="*",
+		type=str,
+		help="A library, or a source and target directory, like run. Leave empty to run all \
+			libraries.")
+
+	# worker - run the jobs of an atran serve
+	p_worker = subparsers.add_parser("worker", help="Run encoders for an atran serve, on this or \
+		another machine that sees the library files at the same paths.")
+	p_worker.set_defaults(cmd="worker")
+	p_worker.add_argument("--address", "-a",
+		type=str,
+		dest="address",
+		default=None,
+		help="The address of the server, host:port or the path of a unix socket. Defaults to the \
+			server_address setting.")
+	p_worker.add_argument("--jobs", "-j",
+		type=int,
+		dest="jobs",
+		default=-1,
+		help="Number of encoders to run at once. Defaults to the number of cpus.")
+
 	#*	Parse arguments, open settings, open database etc.
 	#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
 	args = ap.parse_args()
@@ -690,7 +4919,9 @@ if __name__ == "__main__":
 		cmd_config(ndb)
 	else:
 		dbc = sqlite3.connect(os.path.join(atran_path, "profile.db3"))
+		upgrade_database(dbc)
 	dbc.row_factory = sqlite3.Row
+	configure_database(dbc)
 
 	# commands dictionary holding pointer to the functions
 	commands = {
@@ -698,7 +4929,12 @@ if __name__ == "__main__":
 		"list": cmd_list,
 		"path": cmd_path,
 		"config": cmd_config,
-		"run": cmd_run
+		"stats": cmd_stats,
+		"run": cmd_run,
+		"watch": cmd_watch,
+		"plan": cmd_plan,
+		"serve": cmd_serve,
+		"worker": cmd_worker
 	}
 	
 	#*	Try and run, catch exceptions
@@ -715,10 +4951,13 @@ if __name__ == "__main__":
 		print >> sys.stderr, "  path =",e.path
 	except Path.AlreadyExists:
 		print >> sys.stderr, "Error: Path already in library database!"
+	except Library.ProfileExists:
+		print >> sys.stderr, "Error: The library already has an output in that target directory."
+	except Library.ProfileNotFound:
+		print >> sys.stderr, "Error: The library has no profile with that target directory."
 	except KeyboardInterrupt:
 		print >> sys.stderr
 		print >> sys.stderr, "Terminated early from user input."
-		# todo: make this work for multiprocessing
 	except sqlite3.OperationalError as e:
 		print >> sys.stderr, "Error: Sqlite3 encountered a operational error: '"+str(e)+"'"
 
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import os, sys, argparse, random
+
+#*		Synthetic library generator
+#*	builds a source tree shaped like a music collection (artist/album/track) with album art and
+#*	other files mixed in, for benchmarking the transcoder without real audio.
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+# copy extension files placed in some album directories, and files no library should pick up.
+copy_names = ["cover.jpg", "folder.jpg", "album.cue"]
+noise_names = ["rip.log", "notes.txt", ".DS_Store"]
+
+# the relative directories of a tree with the given depth and fanout
+def directories(depth, fanout):
+	dirs = [""]
+	for level in range(depth):
+		dirs = [os.path.join(d, "d%02d" % i) for d in dirs for i in range(fanout)]
+	return dirs
+
+# generates a tree of count source files under root. returns the number of files created.
+# copy_ratio and noise_ratio are the fraction of directories with copy and noise files in them.
+# size is the size of each source file in bytes, sources are sparse so they are cheap to make.
+def generate(root, count, depth=3, fanout=10, ext=".wav", copy_ratio=0.5, noise_ratio=0.1,
+		size=0, seed=0):
+	rand = random.Random(seed)
+	dirs = directories(depth, fanout)
+	per_dir = max(1, count // len(dirs))
+	created = 0
+
+	for i, d in enumerate(dirs):
+		if created >= count:
+			break
+		path = os.path.join(root, d)
+		if not os.path.isdir(path):
+			os.makedirs(path)
+
+		n = min(per_dir if i < len(dirs)-1 else count-created, count-created)
+		for t in range(n):
+			fp = open(os.path.join(path, "%04d track%s" % (t, ext)), "wb")
+			if size > 0:
+				fp.truncate(size)
+			fp.close()
+		created += n
+
+		if rand.random() < copy_ratio:
+			open(os.path.join(path, rand.choice(copy_names)), "wb").close()
+		if rand.random() < noise_ratio:
+			open(os.path.join(path, rand.choice(noise_names)), "wb").close()
+
+	return created
+
+if __name__ == "__main__":
+	ap = argparse.ArgumentParser(description="Generate a synthetic source tree for benchmarks")
+	ap.add_argument("root",
+		type=str,
+		help="Directory to create the tree in.")
+	ap.add_argument("--files", "-n",
+		type=int,
+		default=10000,
+		help="Number of source files to create.")
+	ap.add_argument("--depth", "-d",
+		type=int,
+		default=3,
+		help="Number of directory levels above the source files.")
+	ap.add_argument("--fanout",
+		type=int,
+		default=10,
+		help="Number of subdirectories in each directory.")
+	ap.add_argument("--size",
+		type=int,
+		default=0,
+		help="Size of each source file in bytes.")
+	args = ap.parse_args()
+
+	n = generate(args.root, args.files, args.depth, args.fanout, size=args.size)
+	print "Created", n, "source files under", args.root
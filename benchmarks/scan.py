@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+import os, sys, argparse, time, shutil, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+import atran
+import generate
+
+#*		Scanner benchmark
+#*	times a scan of a synthetic tree with each of the scanners. every scanner gets a fresh target
+#*	tree, the first pass creates the target directories and the second finds them all there.
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+def bench(source, target, scanner, passes):
+	atran.Settings.properties["scanner"] = scanner
+	times = []
+	for i in range(passes):
+		lib = atran.Library(source, target)
+		start = time.time()
+		tr, cp, tr_skip, cp_skip = lib.scan()
+		times.append(time.time()-start)
+	return times, len(tr)+tr_skip, len(cp)+cp_skip
+
+if __name__ == "__main__":
+	ap = argparse.ArgumentParser(description="Compare the scanners on a synthetic tree")
+	ap.add_argument("--files", "-n",
+		type=int,
+		default=1000000,
+		help="Number of source files in the tree.")
+	ap.add_argument("--passes", "-p",
+		type=int,
+		default=2,
+		help="Number of scans to time for each scanner.")
+	ap.add_argument("--dir",
+		type=str,
+		default=None,
+		help="Where to build the trees. Defaults to a temporary directory.")
+	args = ap.parse_args()
+
+	atran.Settings.properties["default_exts"] = [".wav", ".mp3"]
+	atran.Settings.properties["default_copy_exts"] = [".jpg", ".cue"]
+	if atran.scandir is None:
+		print >> sys.stderr, "Warning: no scandir available, the scandir scanner will list \
+			directories with os.listdir."
+
+	root = tempfile.mkdtemp(dir=args.dir)
+	try:
+		source = os.path.join(root, "source")
+		start = time.time()
+		generate.generate(source, args.files)
+		print "generated", args.files, "files in", "%.1fs" % (time.time()-start)
+
+		for scanner in ["walk", "scandir"]:
+			times, ntr, ncp = bench(source, os.path.join(root, scanner), scanner, args.passes)
+			print "%-8s" % scanner, " ".join("%.2fs" % t for t in times), \
+				"(%d transcode, %d copy)" % (ntr, ncp)
+	finally:
+		shutil.rmtree(root)
@@ -0,0 +1,7 @@
+#!/bin/sh
+# atran-protocol: batch
+# batch protocol version of stub.sh.
+while IFS= read -r src && IFS= read -r dst; do
+	: > "$dst"
+	echo "0 $dst"
+done
@@ -0,0 +1,4 @@
+#!/bin/sh
+# stub encoder for the benchmarks. creates an empty target without reading the source, so a run
+# only measures atran itself.
+: > "$2"
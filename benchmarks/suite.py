@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+import os, sys, argparse, time, shutil, tempfile, subprocess, json, resource, sqlite3
+
+bench_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(bench_path, ".."))
+import atran
+import generate
+
+#*		Benchmark suite
+#*	times atran's own work on synthetic trees of different sizes, with a stub encoder so encoding
+#*	costs next to nothing. every stage runs in its own process against the same database and trees,
+#*	so the peak memory of a stage is its own. results are written as one json object a line.
+#*~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~*#
+# the stages in the order they are run. "startup" does nothing, it is the baseline that the other
+# stages' syscalls are counted from.
+stages = ["startup", "import", "export", "scan", "rescan", "deep-clean", "transcode",
+	"retranscode", "remove", "delete"]
+
+library = "bench"
+
+# sets up atran in a stage process the way __main__ would, with the settings given to the suite
+def setup(opts):
+	atran.Settings.properties.update(opts["settings"])
+	atran.dbc = sqlite3.connect(opts["db"])
+	atran.dbc.row_factory = sqlite3.Row
+	atran.upgrade_database(atran.dbc)
+	atran.configure_database(atran.dbc)
+
+# the tracked paths of the library, one for every source directory or every source file
+def tracked_paths(opts):
+	paths = []
+	for root, dirs, files in os.walk(opts["source"]):
+		dirs.sort()
+		rel = os.path.relpath(root, opts["source"])
+		if opts["track"] == "files":
+			paths.extend(os.path.join(rel, f) for f in sorted(files) \
+				if f.endswith(opts["settings"]["default_exts"][0]))
+		elif not dirs:
+			paths.append(rel)
+	return paths
+
+def count_paths():
+	return atran.dbc.execute("SELECT COUNT(*) FROM paths").fetchone()[0]
+
+# runs the library through the planner the same way run does, cleaning up orphaned outputs
+# afterwards. returns the files looked at.
+def transcode(stream):
+	lib = atran.Library(library)
+	workers = atran.make_workers()
+	atran.RunPlanner([lib], workers, False, stream, None).run()
+	if workers:
+		workers.close()
+		workers.join()
+	return sum(lib.found)+sum(lib.skipped)
+
+# runs a single stage. returns the number of jobs it did, the paths or files it went through.
+def run_stage(stage, opts):
+	if stage == "startup":
+		return 0
+	elif stage == "import":
+		atran.Library(library, opts["source"], opts["target"])
+		paths = tracked_paths(opts)
+		fp = tempfile.TemporaryFile()
+		fp.write("".join("~~/"+p+"\n" for p in paths))
+		fp.seek(0)
+		sys.stdin = fp
+		atran.cmd_path(argparse.Namespace(add=None, import_paths=library, export=None,
+			remove=None, remove_only=None))
+		return count_paths()
+	elif stage == "export":
+		atran.Library(library).export_paths()
+		return count_paths()
+	elif stage in ["scan", "rescan"]:
+		tr, cp, tr_skip, cp_skip = atran.Library(library).scan()
+		return len(tr)+len(cp)+tr_skip+cp_skip
+	elif stage == "deep-clean":
+		lib = atran.Library(library)
+		lib.open_index()
+		lib.clean_tree()
+		return opts["files"]
+	elif stage in ["transcode", "retranscode"]:
+		return transcode(opts["stream"])
+	elif stage == "remove":
+		before = count_paths()
+		lib = atran.Library(library)
+		for d in sorted(os.listdir(opts["source"])):
+			lib.remove_path("~~/"+d)
+		return before-count_paths()
+	elif stage == "delete":
+		# the paths are gone by now, what's left to delete is the file index
+		before = atran.dbc.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+		atran.Library.remove(library)
+		return before
+
+# entry point of a stage process. writes its measurements as json to the result file.
+def stage_main(stage, opts_path, result_path):
+	opts = json.load(open(opts_path))
+	setup(opts)
+	start = time.time()
+	jobs = run_stage(stage, opts)
+	wall = time.time()-start
+	atran.dbc.close()
+
+	json.dump({
+		"wall": wall,
+		"jobs": jobs,
+		"peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+		"children_peak_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+	}, open(result_path, "w"))
+
+# runs a stage in a new process, under strace if syscalls are being counted. returns the stage's
+# measurements, with the number of syscalls made added when counted.
+def spawn(stage, opts_path, work, strace):
+	result_path = os.path.join(work, "result.json")
+	cmd = [sys.executable, os.path.realpath(__file__), "--stage", stage, opts_path, result_path]
+	trace_path = os.path.join(work, "strace.txt")
+	if strace:
+		cmd = ["strace", "-f", "-c", "-o", trace_path] + cmd
+
+	devnull = open(os.devnull, "w")
+	try:
+		if subprocess.call(cmd, stdout=devnull) != 0:
+			raise RuntimeError("stage "+stage+" failed")
+	finally:
+		devnull.close()
+
+	result = json.load(open(result_path))
+	if strace:
+		result["syscalls"] = strace_calls(trace_path)
+	return result
+
+# the total number of calls from an strace -c summary
+def strace_calls(path):
+	for line in open(path):
+		fields = line.split()
+		if fields and fields[-1] == "total":
+			return int(fields[3])
+	return None
+
+# runs every stage once against a fresh database and target tree. returns stage -> measurements.
+def run_pass(source, work, files, args, strace):
+	target = os.path.join(work, "target")
+	opts = {
+		"db": os.path.join(work, "profile.db3"),
+		"source": source,
+		"target": target,
+		"files": files,
+		"track": args.track,
+		"stream": args.stream,
+		"settings": {
+			"default_exts": [".wav", ".mp3"],
+			"default_copy_exts": [".jpg", ".cue"],
+			"default_script_path": os.path.abspath(args.encoder),
+			"scanner": args.scanner,
+			"executor": args.executor,
+			"multithreaded": args.cores != 1,
+			"cores": args.cores,
+			"cache_size": 0
+		}
+	}
+	opts_path = os.path.join(work, "opts.json")
+	json.dump(opts, open(opts_path, "w"))
+
+	db = sqlite3.connect(opts["db"])
+	atran.create_database(db)
+	db.close()
+
+	results = dict()
+	for stage in stages:
+		results[stage] = spawn(stage, opts_path, work, strace)
+	return results
+
+# the git revision of the tree being benchmarked, if there is one
+def revision():
+	try:
+		devnull = open(os.devnull, "w")
+		return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+			cwd=bench_path, stderr=devnull).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+# benchmarks one tree size, giving a result record for each stage
+def bench(files, args, root):
+	source = os.path.join(root, "source")
+	start = time.time()
+	generate.generate(source, files, args.depth, args.fanout)
+	print >> sys.stderr, "generated", files, "files in", "%.1fs" % (time.time()-start)
+
+	try:
+		work = tempfile.mkdtemp(dir=root)
+		timed = run_pass(source, work, files, args, False)
+		shutil.rmtree(work)
+
+		traced = None
+		if args.syscalls:
+			# strace slows everything down, so the counts come from a pass of their own
+			work = tempfile.mkdtemp(dir=root)
+			traced = run_pass(source, work, files, args, True)
+			shutil.rmtree(work)
+	finally:
+		shutil.rmtree(source)
+
+	records = []
+	for stage in stages[1:]:
+		r = timed[stage]
+		record = {
+			"revision": args.revision,
+			"files": files,
+			"stage": stage,
+			"scanner": args.scanner,
+			"executor": args.executor,
+			"wall": round(r["wall"], 4),
+			"jobs": r["jobs"],
+			"jobs_per_sec": round(r["jobs"]/r["wall"], 1) if r["wall"] > 0 else None,
+			"peak_rss_kb": r["peak_rss_kb"],
+			"children_peak_rss_kb": r["children_peak_rss_kb"],
+			"syscalls": None,
+			"syscalls_per_file": None
+		}
+		if traced is not None and traced[stage]["syscalls"] is not None:
+			calls = traced[stage]["syscalls"]-(traced["startup"]["syscalls"] or 0)
+			record["syscalls"] = calls
+			record["syscalls_per_file"] = round(float(calls)/files, 2)
+		records.append(record)
+	return records
+
+if __name__ == "__main__":
+	if len(sys.argv) == 5 and sys.argv[1] == "--stage":
+		stage_main(*sys.argv[2:])
+		sys.exit(0)
+
+	ap = argparse.ArgumentParser(description="Benchmark atran's overhead on synthetic trees. \
+		Results are written as json lines.")
+	ap.add_argument("--files", "-n",
+		type=int,
+		nargs="+",
+		default=[10000],
+		help="Number of source files in each tree to benchmark, e.g. 10000 100000 1000000.")
+	ap.add_argument("--depth", "-d",
+		type=int,
+		default=3,
+		help="Number of directory levels above the source files.")
+	ap.add_argument("--fanout",
+		type=int,
+		default=10,
+		help="Number of subdirectories in each directory.")
+	ap.add_argument("--track",
+		choices=["dirs", "files"],
+		default="dirs",
+		help="Track every source directory or every source file as a library path.")
+	ap.add_argument("--scanner",
+		choices=["walk", "scandir"],
+		default="walk",
+		help="The scanner setting to benchmark.")
+	ap.add_argument("--executor",
+		choices=["pool", "process"],
+		default="pool",
+		help="The executor setting to benchmark.")
+	ap.add_argument("--cores", "-c",
+		type=int,
+		default=-1,
+		help="Number of workers, 1 runs jobs in the benchmark process. Defaults to the number of \
+			cpus.")
+	ap.add_argument("--encoder",
+		type=str,
+		default=os.path.join(bench_path, "stub.sh"),
+		help="Encoder script for the transcode stages. Defaults to the stub encoder.")
+	ap.add_argument("--stream", "-s",
+		action="store_true",
+		help="Run the transcode stages in stream mode.")
+	ap.add_argument("--syscalls",
+		action="store_true",
+		help="Count the syscalls of each stage with strace, in an extra pass.")
+	ap.add_argument("--output", "-o",
+		type=str,
+		default=None,
+		help="Append the results to a file instead of printing them.")
+	ap.add_argument("--dir",
+		type=str,
+		default=None,
+		help="Where to build the trees. Defaults to a temporary directory.")
+	args = ap.parse_args()
+	args.revision = revision()
+
+	if args.syscalls and subprocess.call("command -v strace", shell=True,
+			stdout=open(os.devnull, "w")) != 0:
+		print >> sys.stderr, "Error: --syscalls needs strace to be installed."
+		sys.exit(1)
+
+	out = open(args.output, "a") if args.output else sys.stdout
+	root = tempfile.mkdtemp(dir=args.dir)
+	try:
+		for files in args.files:
+			for record in bench(files, args, root):
+				out.write(json.dumps(record, sort_keys=True)+"\n")
+				out.flush()
+				print >> sys.stderr, "%8d %-12s %9.3fs %10s jobs/s %8d KB" % (files, \
+					record["stage"], record["wall"], record["jobs_per_sec"], record["peak_rss_kb"])
+	finally:
+		shutil.rmtree(root)
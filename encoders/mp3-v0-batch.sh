@@ -0,0 +1,8 @@
+#!/bin/sh
+# atran-protocol: batch
+# same as mp3-v0.sh, but kept running for the whole run. reads a source line and a target line for
+# each job from stdin and prints the exit status and target when the job is done.
+while IFS= read -r src && IFS= read -r dst; do
+	lame -V 0 "$src" "$dst" >/dev/null 2>&1
+	echo "$? $dst"
+done